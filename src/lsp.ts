@@ -50,6 +50,10 @@ async function startServer(ctx: vscode.ExtensionContext) {
         ],
 
         diagnosticCollectionName: 'kconfig',
+        initializationOptions: {
+            diagnosticDelay: kEnv.getConfig<number>('diagnosticDelay'),
+            completionDelay: kEnv.getConfig<number>('completionDelay'),
+        },
     };
 
     client = new LanguageClient('Kconfig', serverOptions, clientOptions);
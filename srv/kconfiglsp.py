@@ -2,17 +2,20 @@
 #
 # SPDX-License-Identifier: LicenseRef-Nordic-1-Clause
 
-from typing import Optional, List, Dict
+from typing import Any, Iterable, Optional, List, Dict, Set, Tuple
 import kconfiglib as kconfig
 import sys
 import os
 import re
+import bisect
+import hashlib
+import itertools
 import enum
 import argparse
-from rpc import handler, RPCError
+from rpc import handler, encode_json, RPCError
 from lsp import (CodeAction, CompletionItemKind, Diagnostic, DiagnosticRelatedInfo, DocumentSymbol,
                  FileChangeKind, InsertTextFormat, LSPServer, MarkupContent, Position, Location,
-                 Snippet, SymbolInformation, SymbolKind, TextEdit, Uri, TextDocument, Range,
+                 SymbolInformation, SymbolKind, TextEdit, Uri, TextDocument, Range,
                  documentStore)
 
 VERSION = '1.0'
@@ -42,6 +45,28 @@ VERSION = '1.0'
 
 KCONFIG_WARN_LVL = Diagnostic.WARNING
 ID_SEP = '@'
+# Default delay between an edit and the following diagnostics refresh, in seconds:
+DIAG_DELAY = 0.25
+# Default delay before responding to completion requests, in seconds.
+# Requests superseded by a new request within the delay get an empty response:
+COMPLETION_DELAY = 0.02
+# Delay for coalescing file change events before invalidating contexts, in seconds:
+INVALIDATE_DELAY = 0.05
+# Max number of items in completion lists without a prefix:
+COMPLETION_LIMIT = 200
+
+# Value of a conf file entry, following the = in CONFIG_ABC=y:
+_ENTRY_VALUE_RE = re.compile(r'"[^"]+"|\w+')
+_HEX_RE = re.compile(r'0x[a-fA-F\d]+')
+# Location of the devicetree pickle in a build directory:
+_EDT_PICKLE_SUFFIX = '/zephyr/edt.pickle'
+_INT_RE = re.compile(r'\d+')
+_SYM_NAME_RE = re.compile(r'\w*')
+_BOOL_VALUES = frozenset(('y', 'n'))
+_DEFINED_AT_RE = re.compile(r'\s*\(defined at.*?\)\s*')
+_GCC_LOC_RE = re.compile(r'(^[\w\/\\-]+:\d+:\s*)?(error:)?\s*(.*)')
+# kconfiglib warnings containing any of these are dropped:
+_IGNORED_DIAG_SUBSTRINGS = ('set more than once.', )
 
 
 class KconfigErrorCode(enum.IntEnum):
@@ -104,21 +129,16 @@ class Kconfig(kconfig.Kconfig):
         if not linenr:
             linenr = 1
 
-        ignored_diags = ['set more than once.']
-
-        if len([ignore for ignore in ignored_diags if ignore in msg]) > 0:
+        if any(ignore in msg for ignore in _IGNORED_DIAG_SUBSTRINGS):
             # Ignore this diagnostic. It is either too verbose, or already covered by some
             # manual check.
             return
 
-        if not filename in self.diags:
-            self.diags[filename] = []
-
         # Strip out potentially very long definition references.
         # They're redundant, since the user can ctrl+click on the symbol to interactively find them.
-        msg = re.sub(r'\s*\(defined at.*?\)\s*', ' ', msg)
+        msg = _DEFINED_AT_RE.sub(' ', msg)
 
-        self.diags[filename].append(
+        self.diags.setdefault(filename, []).append(
             Diagnostic(msg,
                        Position(int(linenr - 1), 0).range, KCONFIG_WARN_LVL))
 
@@ -143,51 +163,40 @@ def _visible(node):
         (node.item == kconfig.MENU and not kconfig.expr_value(node.visibility))
 
 
-def _children(node):
-    """Get the child nodes of a given MenuNode"""
-    def get_children(node):
-        children = []
-        node = node.list
-        while node:
-            children.append(node)
-            node = node.next
-        return children
-
-    if isinstance(node.item, kconfig.Choice):
-        # Choices may be appended to in multiple locations.
-        # For ease of use, gather all options added to this choice, so users
-        # can see all valid option in every location.
-        # See menuconfig.py's _shown_nodes for additional info.
-        choice: kconfig.Choice = node.item
-        children = []
-        # Gather the current node's symbols first, so those are preferred when the symbol
-        # is added in multiple places:
-        symbols = {n.item for n in get_children(node) if isinstance(n, kconfig.Symbol)}
-
-        for choice_node in choice.nodes:
-            for child in get_children(choice_node):
-                if not isinstance(child.item, kconfig.Symbol):
-                    children.append(child)
-                elif child.item not in symbols or choice_node is node:
-                    children.append(child)
-                    # Only show each symbol once:
-                    symbols.add(child.item)
-
-        return children
-
-    return get_children(node)
-
-
-def _suboption_depth(node):
-    """In menuconfig, nodes that aren't children of menuconfigs are rendered
-       in the same menu, but indented. Get the depth of this indentation.
-    """
-    parent = node.parent
-    depth = 0
-    while not parent.is_menuconfig:
-        depth += 1
-        parent = parent.parent
-    return depth
+def _iter_children(node):
+    """Iterate over the child nodes of a given MenuNode"""
+    if not isinstance(node.item, kconfig.Choice):
+        child = node.list
+        while child:
+            yield child
+            child = child.next
+        return
+
+    # Choices may be appended to in multiple locations.
+    # For ease of use, gather all options added to this choice, so users
+    # can see all valid option in every location.
+    # See menuconfig.py's _shown_nodes for additional info.
+    choice: kconfig.Choice = node.item
+
+    # Gather the current node's symbols first, so those are preferred when the symbol
+    # is added in multiple places:
+    symbols = set()
+    child = node.list
+    while child:
+        if isinstance(child.item, kconfig.Symbol):
+            symbols.add(child.item)
+        child = child.next
+
+    for choice_node in choice.nodes:
+        child = choice_node.list
+        while child:
+            if not isinstance(child.item, kconfig.Symbol):
+                yield child
+            elif choice_node is node or child.item not in symbols:
+                yield child
+                # Only show each symbol once:
+                symbols.add(child.item)
+            child = child.next
 
 
 def _loc(sym: kconfig.Symbol):
@@ -213,9 +222,46 @@ def _symbolitem(sym: kconfig.Symbol):
     return item
 
 
-def _filter_match(filter: str, name: str):
-    """Filter match function used for narrowing lists in searches and autocompletions"""
-    return name.startswith(filter)  # TODO: implement fuzzy match?
+def _choice_snippet(assignable):
+    """Snippet for choosing between the given assignable tristate values."""
+    choices = [kconfig.TRI_TO_STR[val] for val in assignable]
+    choices.reverse()  # sym.assignable shows 'n' first, but user normally wants 'y'
+    # Choice snippet, or a plain tabstop if there's nothing to choose from:
+    if choices:
+        return f'${{1|{",".join(choices)}|}}'
+    return '${1}'
+
+
+# Symbol.assignable is an ascending tuple of tristate values, so each of its few possible values
+# can be mapped to its choice snippet up front:
+_ASSIGNABLE_CHOICES = {
+    assignable: _choice_snippet(assignable)
+    for count in range(4) for assignable in itertools.combinations((0, 1, 2), count)
+}
+
+
+def _bool_insert_text(sym: kconfig.Symbol):
+    assignable = sym.assignable
+    choices = _ASSIGNABLE_CHOICES.get(assignable) or _choice_snippet(assignable)
+    return f'CONFIG_{sym.name}={choices}'
+
+
+# Completion snippets for assigning a value to a symbol, by symbol type.
+# The snippets are simple enough to format directly, without building a Snippet:
+_INSERT_TEXT = {
+    kconfig.BOOL: _bool_insert_text,
+    kconfig.TRISTATE: _bool_insert_text,
+    kconfig.STRING: lambda sym: f'CONFIG_{sym.name}="${{1}}"',
+    kconfig.HEX: lambda sym: f'CONFIG_{sym.name}=0x',
+}
+
+
+def _insert_text(sym: kconfig.Symbol, sym_type: int):
+    """Get the completion snippet for assigning a value to the given symbol of the given type."""
+    fmt = _INSERT_TEXT.get(sym_type)
+    if fmt:
+        return fmt(sym)
+    return f'CONFIG_{sym.name}='  # freeform value
 
 
 def _missing_deps(sym):
@@ -244,7 +290,7 @@ class KconfigMenu:
         sym = node.item
         item = {
             'visible':
-            _visible(node) != 0,
+            self.ctx._visible(node) != 0,
             'loc':
             Location(Uri.file(os.path.join(self.ctx.env['ZEPHYR_BASE'], node.filename)),
                      Position(node.linenr - 1, 0).range),
@@ -253,7 +299,7 @@ class KconfigMenu:
             'hasChildren':
             node.list != None or isinstance(sym, kconfig.Choice),
             'depth':
-            _suboption_depth(node),
+            self.ctx._suboption_depth(node),
             'id':
             self.ctx._node_id(node),
         }
@@ -274,7 +320,7 @@ class KconfigMenu:
             item['kind'] = 'symbol'
         elif isinstance(sym, kconfig.Choice):
             item['type'] = kconfig.TYPE_TO_STR[sym.type]
-            item['val'] = _prompt(sym.selection)
+            item['val'] = self.ctx._prompt(sym.selection)
             item['userValue'] = sym.user_value
             item['name'] = sym.name
             item['kind'] = 'choice'
@@ -291,8 +337,8 @@ class KconfigMenu:
     def items(self):
         """The list of MenuItems this menu presents."""
         return [
-            self._menuitem(node) for node in _children(self.node)
-            if self.show_all or (node.prompt and _visible(node))
+            self._menuitem(node) for node in _iter_children(self.node)
+            if self.show_all or (node.prompt and self.ctx._visible(node))
         ]
 
     def to_dict(self):
@@ -303,6 +349,15 @@ class KconfigMenu:
         }
 
 
+# Conversion of the raw entry values to the values seen by kconfig, by entry kind:
+_ENTRY_VALUE_PARSERS = {
+    kconfig.STRING: lambda raw: raw[1:-1],  # strip out quotes
+    kconfig.BOOL: lambda raw: raw,
+    kconfig.HEX: lambda raw: int(raw, 16),
+    kconfig.INT: int,
+}
+
+
 class ConfEntry:
     def __init__(self, name: str, loc: Location, assignment: str, value_range: Range):
         """
@@ -312,6 +367,7 @@ class ConfEntry:
         self.loc = loc
         self.raw = assignment.strip()
         self.value_range = value_range
+        self._kind: Optional[int] = None
 
     @property
     def range(self):
@@ -332,39 +388,41 @@ class ConfEntry:
         return self.raw.startswith('"') and self.raw.endswith('"')
 
     def is_bool(self):
-        return self.raw in ['y', 'n']
+        return self.raw in _BOOL_VALUES
 
     def is_hex(self):
-        return re.match(r'0x[a-fA-F\d]+', self.raw)
+        return _HEX_RE.match(self.raw)
 
     def is_int(self):
-        return re.match(r'\d+', self.raw)
+        return _INT_RE.match(self.raw)
+
+    @property
+    def kind(self):
+        """kconfig type of the assigned value, derived from its syntax."""
+        if self._kind is None:
+            if self.is_string():
+                self._kind = kconfig.STRING
+            elif self.is_hex():
+                self._kind = kconfig.HEX
+            elif self.is_int():
+                self._kind = kconfig.INT
+            elif self.is_bool():
+                self._kind = kconfig.BOOL
+            else:
+                self._kind = kconfig.UNKNOWN
+        return self._kind
 
     @property
     def value(self):
         """Value assigned in the entry, as seen by kconfig"""
-        if self.is_string():
-            return self.raw[1:-1]  # strip out quotes
-        if self.is_bool():
-            return self.raw
-        if self.is_hex():
-            return int(self.raw, 16)
-        if self.is_int():
-            return int(self.raw)
+        parse = _ENTRY_VALUE_PARSERS.get(self.kind)
+        if parse:
+            return parse(self.raw)
 
     @property
     def type(self):
         """Human readable entry type, derived from the assigned value."""
-        if self.is_string():
-            return kconfig.TYPE_TO_STR[kconfig.STRING]
-        if self.is_hex():
-            return kconfig.TYPE_TO_STR[kconfig.HEX]
-        if self.is_int():
-            return kconfig.TYPE_TO_STR[kconfig.INT]
-        if self.is_bool():
-            return kconfig.TYPE_TO_STR[kconfig.BOOL]
-
-        return kconfig.TYPE_TO_STR[kconfig.UNKNOWN]
+        return kconfig.TYPE_TO_STR[self.kind]
 
     @property
     def line_range(self):
@@ -388,6 +446,18 @@ class ConfFile:
         """
         self.uri = uri
         self.diags: List[Diagnostic] = []
+        # Diagnostics sorted by start line, as (line, index) pairs, for overlap searches.
+        # Diagnostics are only ever appended between clear_diags() calls, so the index is
+        # up to date as long as it covers every diagnostic:
+        self._diag_index: List[Tuple[int, int]] = []
+        self._diag_max_lines = 0
+        self._entries: Optional[List[ConfEntry]] = None
+        self._entries_by_name: Dict[str, List[ConfEntry]] = {}
+        self._entries_doc: Optional[TextDocument] = None
+        self._entries_version = -1
+        self._doc_symbols: List[DocumentSymbol] = []
+        self._doc_symbols_entries: Optional[List[ConfEntry]] = None
+        self._doc_symbols_version = -1
 
     @property
     def doc(self) -> TextDocument:
@@ -395,21 +465,96 @@ class ConfFile:
         return documentStore.get(self.uri)
 
     def entries(self) -> List[ConfEntry]:
-        """The ConfEntries in this file"""
+        """
+        The ConfEntries in this file.
+
+        The entries are cached until the underlying document changes.
+        """
+        doc = self.doc
+        if (self._entries is not None and doc is self._entries_doc
+                and doc.revision == self._entries_version):
+            return self._entries
+
         entries = []
-        for linenr, line in enumerate(self.doc.lines):
-            match = re.match(r'^\s*(CONFIG_(\w+))\s*\=("[^"]+"|\w+)', line)
-            if match:
-                range = Range(Position(linenr, match.start(1)), Position(linenr, match.end(1)))
-                value_range = Range(Position(linenr, match.start(3)),
-                                    Position(linenr, match.end(3)))
-                entries.append(ConfEntry(match[2], Location(self.uri, range), match[3],
-                                         value_range))
+        for linenr, raw in enumerate(doc.lines):
+            # Most lines are comments or empty, so reject lines with cheap string operations
+            # before looking for a value:
+            line = raw.lstrip()
+            if not line.startswith('CONFIG_'):
+                continue
+            eq = line.find('=')
+            if eq < 0:
+                continue
+            name_part = line[:eq].rstrip()
+            # Names are made up of word characters (alphanumerics and underscores):
+            if not name_part[len('CONFIG_'):].replace('_', 'x').isalnum():
+                continue
+            start = len(raw) - len(line)
+            value = _ENTRY_VALUE_RE.match(raw, start + eq + 1)
+            if not value:
+                continue
+
+            range = Range(Position(linenr, start), Position(linenr, start + len(name_part)))
+            value_range = Range(Position(linenr, value.start()), Position(linenr, value.end()))
+            entries.append(
+                ConfEntry(name_part[len('CONFIG_'):], Location(self.uri, range), value[0],
+                          value_range))
+
+        self._entries = entries
+        self._entries_by_name = {}
+        for entry in entries:
+            self._entries_by_name.setdefault(entry.name, []).append(entry)
+        self._entries_doc = doc
+        self._entries_version = doc.revision
         return entries
 
+    def clear_diags(self):
+        """Remove all diagnostics from this file."""
+        self.diags.clear()
+        self._diag_index = []
+        self._diag_max_lines = 0
+
+    def diags_in(self, range: Range) -> List[Diagnostic]:
+        """Get the diagnostics overlapping with the given range, in the order they were added."""
+        if len(self._diag_index) != len(self.diags):
+            self._diag_index = sorted((d.range.start.line, i) for i, d in enumerate(self.diags))
+            self._diag_max_lines = max(d.range.end.line - d.range.start.line for d in self.diags)
+
+        # Only diagnostics starting within the range, or at most the longest diagnostic's line
+        # count before it, can overlap:
+        start = bisect.bisect_left(self._diag_index,
+                                   (range.start.line - self._diag_max_lines, -1))
+        end = bisect.bisect_left(self._diag_index, (range.end.line + 1, -1), start)
+        candidates = sorted(i for _, i in self._diag_index[start:end])
+        return [self.diags[i] for i in candidates if range.overlaps(self.diags[i].range)]
+
+    def doc_symbols(self, ctx: 'KconfigContext') -> List[DocumentSymbol]:
+        """
+        The DocumentSymbols for the entries in this file, with prompts from the given context.
+
+        The symbols are cached until the entries change or the context is parsed again.
+        """
+        entries = self.entries()
+        if entries is not self._doc_symbols_entries or ctx.version != self._doc_symbols_version:
+
+            def doc_sym(e: ConfEntry):
+                sym = ctx.get(e.name)
+                if sym:
+                    prompt = _prompt(sym, True)
+                else:
+                    prompt = None
+                return DocumentSymbol(ctx.config_name(e.name), SymbolKind.PROPERTY, e.full_range,
+                                      prompt)
+
+            self._doc_symbols = [doc_sym(e) for e in entries]
+            self._doc_symbols_entries = entries
+            self._doc_symbols_version = ctx.version
+        return self._doc_symbols
+
     def find(self, name) -> List[ConfEntry]:
         """Find all ConfEntries that configure a symbol with the given name."""
-        return [entry for entry in self.entries() if entry.name == name]
+        self.entries()  # Refresh the index
+        return list(self._entries_by_name.get(name, []))
 
     def __repr__(self):
         return str(self.uri)
@@ -421,11 +566,12 @@ class BoardConf:
         self.name = name
         self.arch = arch
         self.dir = dir
+        self._conf_file = ConfFile(Uri.file(os.path.join(self.dir, self.name + '_defconfig')))
 
     @property
     def conf_file(self):
-        """Get the path of the conf file that must be included when building with this board"""
-        return ConfFile(Uri.file(os.path.join(self.dir, self.name + '_defconfig')))
+        """Get the conf file that must be included when building with this board"""
+        return self._conf_file
 
 
 class KconfigContext:
@@ -445,6 +591,36 @@ class KconfigContext:
         self.cmd_diags: List[Diagnostic] = []
         self.last_access = 0
         self.kconfig_diags: Dict[str, List[Diagnostic]] = {}
+        self.modified: Set[str] = set()
+        self._files_by_uri: Dict[str, ConfFile] = {}
+        self._index_files()
+        self._depths: Dict[int, int] = {}
+        # Reverse lookup tables for the kconfig lists, by object ID:
+        self._menu_idx: Dict[int, int] = {}
+        self._choice_idx: Dict[int, int] = {}
+        self._comment_idx: Dict[int, int] = {}
+        self._item_node_idx: Dict[int, int] = {}
+        self._node_id_cache: Dict[int, str] = {}
+        # Digest of the sources read by the last successful parse:
+        self._sources_digest: Optional[bytes] = None
+        # Names of the config symbols, sorted for prefix searches:
+        self._sym_names: List[str] = []
+        # Config symbols in the same order as their names, so a slice of the sorted names can
+        # be mapped to symbols without dictionary lookups:
+        self._sorted_syms: List[kconfig.Symbol] = []
+        # Visibility of each symbol in _sorted_syms, built on demand:
+        self._sorted_visible: Optional[bytearray] = None
+        # Interned CONFIG_ prefixed names of the config symbols, by symbol name:
+        self._config_names: Dict[str, str] = {}
+        # Evaluated prompt and visibility expressions, valid until the symbol values change:
+        self._expr_cache: Dict[Tuple[str, int], Any] = {}
+        # Completion items for each symbol. The type and assignable values depend on the symbol
+        # values, so these are dropped along with the expression cache:
+        self._completion_items: Dict[str, Dict[str, Any]] = {}
+        # Short and long single line help texts of each symbol, by symbol ID:
+        self._help_cache: Dict[int, Tuple[str, str]] = {}
+        # Visible config symbols in definition order, built on demand:
+        self._visible_syms: Optional[List[kconfig.Symbol]] = None
 
     def initialize_env(self):
         """
@@ -470,7 +646,15 @@ class KconfigContext:
         Throws kconfig errors if the tree can't be parsed.
         """
         self.menu = None
-        self.modified = {}
+        self.modified = set()
+        self._index_files()
+        self._depths.clear()
+        self._node_id_cache.clear()
+        self._help_cache.clear()
+        self._sym_names = []
+        self._sorted_syms = []
+        self._config_names = {}
+        self._values_changed()
         self.clear_diags()
         self.initialize_env()
 
@@ -478,12 +662,13 @@ class KconfigContext:
 
         try:
             self._kconfig.parse()
+            self._index_nodes()
         except kconfig.KconfigError as e:
             loc = self._kconfig.loc()
 
             # Strip out the GCC-style location indicator that is placed on the start of the
             # error message for some messages:
-            match = re.match(r'(^[\w\/\\-]+:\d+:\s*)?(error:)?\s*(.*)', str(e))
+            match = _GCC_LOC_RE.match(str(e))
             if match:
                 msg = match[3]
             else:
@@ -498,8 +683,93 @@ class KconfigContext:
             self.cmd_diags.append(
                 Diagnostic.err('Kconfig failed: ' + str(e), Range(Position.start(),
                                                                   Position.start())))
+
+        self._sources_digest = self._digest_sources() if self.valid else None
         self.version += 1
 
+    def _digest_sources(self):
+        """
+        Hash the files read by the last parse.
+
+        Uses the live editor data from the documentStore where available, as the parser does.
+        """
+        files = [os.path.join(self._kconfig.srctree, f) for f in self._kconfig.kconfig_filenames]
+        if self.env.get('EDT_PICKLE'):
+            files.append(self.env['EDT_PICKLE'])
+
+        digest = hashlib.sha256()
+        for filename in files:
+            digest.update(filename.encode('utf-8') + b'\0')
+            doc = documentStore.get(Uri.file(filename), create=False)
+            if doc and doc.loaded:
+                digest.update(doc.text.encode('utf-8'))
+                continue
+            try:
+                with open(filename, 'rb') as f:
+                    digest.update(f.read())
+            except OSError:
+                digest.update(b'\0')  # Missing files are part of the digest too
+        return digest.digest()
+
+    def revalidate(self):
+        """
+        Mark an invalidated context as valid again, if none of the files read by the
+        last parse have changed since.
+
+        Returns whether the context was revalidated. If it wasn't, the context must be parsed.
+        """
+        if not self._kconfig or not self._sources_digest:
+            return False
+        if self._digest_sources() != self._sources_digest:
+            return False
+        self._kconfig.valid = True
+        return True
+
+    def _values_changed(self):
+        """Drop the cached expression values after the symbol values changed."""
+        self._expr_cache.clear()
+        self._completion_items.clear()
+        self._visible_syms = None
+        self._sorted_visible = None
+
+    def _prompt(self, sym: kconfig.Symbol):
+        """Cached version of _prompt(), only considering prompts whose if expressions are true."""
+        key = ('prompt', id(sym))
+        if key not in self._expr_cache:
+            self._expr_cache[key] = _prompt(sym)
+        return self._expr_cache[key]
+
+    def _visible(self, node: kconfig.MenuNode):
+        """Cached version of _visible()."""
+        key = ('visible', id(node))
+        if key not in self._expr_cache:
+            self._expr_cache[key] = _visible(node)
+        return self._expr_cache[key]
+
+    def _index_files(self):
+        """Build the conf file lookup table. Must be called when the set of conf files changes."""
+        self._files_by_uri = {str(file.uri): file for file in self.all_conf_files}
+
+    def _index_nodes(self):
+        """Build the reverse lookup tables used to encode node IDs."""
+        self._menu_idx = {id(node): i for i, node in enumerate(self._kconfig.menus)}
+        self._choice_idx = {id(choice): i for i, choice in enumerate(self._kconfig.choices)}
+        self._comment_idx = {id(node): i for i, node in enumerate(self._kconfig.comments)}
+        self._item_node_idx = {}
+        for item in [*self._kconfig.syms.values(), *self._kconfig.choices]:
+            for i, node in enumerate(item.nodes):
+                self._item_node_idx[id(node)] = i
+        # Literal values are also symbols, but can be filtered out by checking sym.nodes
+        # which only exists if this is a proper config symbol:
+        self._sym_names = sorted(name for name, sym in self._kconfig.syms.items()
+                                 if getattr(sym, 'nodes', None))
+        self._sorted_syms = [self._kconfig.syms[name] for name in self._sym_names]
+        self._config_names = {name: sys.intern('CONFIG_' + name) for name in self._sym_names}
+
+    def config_name(self, name: str) -> str:
+        """Get the CONFIG_ prefixed name of a symbol, as used in conf files."""
+        return self._config_names.get(name) or 'CONFIG_' + name
+
     def kconfig_diag(self, uri: Uri, diag: Diagnostic):
         if not str(uri) in self.kconfig_diags:
             self.kconfig_diags[str(uri)] = []
@@ -509,9 +779,19 @@ class KconfigContext:
     def valid(self):
         return self._kconfig != None and self._kconfig.valid
 
-    def invalidate(self):
+    def invalidate(self, check_sources=False):
+        """
+        Mark the context as invalid, so the next refresh parses the Kconfig tree again.
+
+        If check_sources is set, the invalidation only concerns changes to the contents of
+        files the last parse read, and the context may be revalidated if their contents are
+        unchanged. Otherwise, the next refresh always parses.
+        """
         if self._kconfig:
             self._kconfig.valid = False
+        if not check_sources:
+            self._sources_digest = None
+        self._depths.clear()
 
     @property
     def all_conf_files(self):
@@ -520,33 +800,55 @@ class KconfigContext:
 
     def has_file(self, uri: Uri):
         """Check whether the given URI represents a conf file this context uses. Does not check board files."""
-        return any([(file.uri == uri) for file in self.all_conf_files])
+        return str(uri) in self._files_by_uri
+
+    def _suboption_depth(self, node):
+        """In menuconfig, nodes that aren't children of menuconfigs are rendered
+           in the same menu, but indented. Get the depth of this indentation.
+
+           All siblings share the same depth, so the depth is cached for each parent node.
+        """
+        parent = node.parent
+        depth = self._depths.get(id(parent))
+        if depth is None:
+            depth = 0
+            it = parent
+            while not it.is_menuconfig:
+                depth += 1
+                it = it.parent
+            self._depths[id(parent)] = depth
+        return depth
 
     def _node_id(self, node: kconfig.MenuNode):
         """Encode a unique ID string for the given menu node"""
         if not self._kconfig:
             return ''
 
+        cached = self._node_id_cache.get(id(node))
+        if cached:
+            return cached
+
         if node == self._kconfig.top_node:
             parts = ['MAINMENU']
         elif node.item == kconfig.MENU:
-            parts = ['MENU', str(self._kconfig.menus.index(node))]
+            parts = ['MENU', str(self._menu_idx[id(node)])]
         elif isinstance(node.item, kconfig.Symbol):
-            parts = ['SYM', node.item.name, str(node.item.nodes.index(node))]
+            parts = ['SYM', node.item.name, str(self._item_node_idx[id(node)])]
         elif isinstance(node.item, kconfig.Choice):
             parts = [
                 'CHOICE',
-                str(self._kconfig.choices.index(node.item)),
-                str(node.item.nodes.index(node))
+                str(self._choice_idx[id(node.item)]),
+                str(self._item_node_idx[id(node)])
             ]
         elif node.item == kconfig.COMMENT:
-            parts = ['COMMENT', str(self._kconfig.comments.index(node))]
+            parts = ['COMMENT', str(self._comment_idx[id(node)])]
         else:
             parts = ['UNKNOWN', node.filename, str(node.linenr)]
 
         parts.insert(0, str(self.version))
 
-        return ID_SEP.join(parts)
+        self._node_id_cache[id(node)] = ID_SEP.join(parts)
+        return self._node_id_cache[id(node)]
 
     def find_node(self, id):
         """Find a menu node based on a node ID"""
@@ -592,14 +894,17 @@ class KconfigContext:
         if not sym:
             raise RPCError(KconfigErrorCode.UNKNOWN_NODE, 'Unknown symbol {}'.format(name))
         valid = sym.set_value(val)
-        if valid and not name in self.modified:
-            self.modified.append(name)
+        self._values_changed()
+        if valid:
+            self.modified.add(name)
 
     def unset(self, name):
         """Revert a previous self.set() call."""
         sym = self.get(name)
         if sym:
             sym.unset_value()
+            self.modified.discard(name)
+            self._values_changed()
 
     def get(self, name) -> Optional[kconfig.Symbol]:
         """Get a kconfig symbol based on its name. The name should NOT include the CONFIG_ prefix."""
@@ -609,7 +914,7 @@ class KconfigContext:
 
     def conf_file(self, uri):
         """Get the config file with the given URI, if any."""
-        return next((file for file in self.all_conf_files if file.uri == uri), None)
+        return self._files_by_uri.get(str(uri))
 
     def diags(self, uri):
         """Get the diagnostics for the conf file with the given URI"""
@@ -626,19 +931,89 @@ class KconfigContext:
 
         self.cmd_diags.clear()
         for conf in self.all_conf_files:
-            conf.diags.clear()
+            conf.clear_diags()
+
+    def symbols(self, filter, visible_only=False):
+        """
+        Get a list of symbols matching the given filter string.
+        Can be used for search or auto completion.
 
-    def symbols(self, filter):
-        """Get a list of symbols matching the given filter string. Can be used for search or auto completion."""
+        Without a filter, all symbols are returned in definition order. Otherwise, the symbols
+        whose names start with the filter are returned in alphabetical order.
+
+        If visible_only is set, symbols that can't currently be set are left out.
+        """
         if filter and filter.startswith('CONFIG_'):
             filter = filter[len('CONFIG_'):]
-        return [
-            sym for sym in self._kconfig.syms.values()
-            # Literal values are also symbols, but can be filtered out by checking sym.nodes
-            # which only exists if this is a proper config symbol:
-            if hasattr(sym, 'nodes') and len(sym.nodes) and (
-                not filter or _filter_match(filter, sym.name))
-        ]
+        syms = self._kconfig.syms
+        if not filter and visible_only:
+            # Visibility walks the dependency expressions, so keep the list until values change:
+            if self._visible_syms is None:
+                self._visible_syms = [sym for sym in self.symbols(None) if sym.visibility]
+            return list(self._visible_syms)
+
+        if not filter:
+            return [
+                sym for sym in syms.values()
+                # Literal values are also symbols, but can be filtered out by checking sym.nodes
+                # which only exists if this is a proper config symbol:
+                if hasattr(sym, 'nodes') and len(sym.nodes)
+            ]
+
+        # All names starting with the filter are in a single slice of the sorted list.
+        # Symbol names only contain word characters, so they all sort before \uffff:
+        # TODO: implement fuzzy match?
+        names = self._sym_names
+        start = bisect.bisect_left(names, filter)
+        end = bisect.bisect_left(names, filter + '\uffff', start)
+        sorted_syms = self._sorted_syms
+        if not visible_only:
+            return sorted_syms[start:end]
+
+        # Look up the visibility in a flat mask that is kept until the values change:
+        if self._sorted_visible is None:
+            self._sorted_visible = bytearray(bool(sym.visibility) for sym in sorted_syms)
+        visible = self._sorted_visible
+        return [sorted_syms[i] for i in range(start, end) if visible[i]]
+
+    def help(self, sym: kconfig.Symbol) -> Tuple[str, str]:
+        """
+        Get the help text of the given symbol, with line breaks replaced by spaces.
+
+        Returns a short form with the help text of the first node that has one, and a long
+        form with the help texts of all its nodes as paragraphs. Both are empty if the symbol
+        has no help text.
+        """
+        help = self._help_cache.get(id(sym))
+        if help is None:
+            texts = [n.help.replace('\n', ' ') for n in sym.nodes if n.help]
+            help = (texts[0] if texts else '', '\n\n'.join(texts))
+            self._help_cache[id(sym)] = help
+        return help
+
+    def completion_item(self, sym: kconfig.Symbol):
+        """Get the completion item for assigning a value to the given symbol."""
+        item = self._completion_items.get(sym.name)
+        if not item:
+            # Symbol.type is computed on every access:
+            sym_type = sym.type
+            item = {
+                'label': self.config_name(sym.name),
+                'kind': CompletionItemKind.VARIABLE,
+                'detail': kconfig.TYPE_TO_STR[sym_type],
+                'documentation': self.help(sym)[0] or ' ',
+                'insertText': _insert_text(sym, sym_type),
+                'insertTextFormat': InsertTextFormat.SNIPPET
+            }
+            self._completion_items[sym.name] = item
+        return item
+
+    def completion_items(self, syms: Iterable[kconfig.Symbol]) -> List[Dict[str, Any]]:
+        """Get the completion items for the given symbols, in order."""
+        # Completion lists span thousands of symbols, and most items are already cached:
+        cached = self._completion_items.get
+        build = self.completion_item
+        return [cached(sym.name) or build(sym) for sym in syms]
 
     def symbol_search(self, query):
         """Search for a symbol with a specific name. Returns a list of symbols as SymbolItems."""
@@ -646,7 +1021,7 @@ class KconfigContext:
 
     def all_entries(self) -> List[ConfEntry]:
         entries = []
-        for file in self.all_conf_files:
+        for file in self._files_by_uri.values():
             entries.extend(file.entries())
         return entries
 
@@ -660,14 +1035,16 @@ class KconfigContext:
 
     def check_type(self, file: ConfFile, entry: ConfEntry, sym: kconfig.Symbol):
         """Check that the configured value has the right type."""
-        if kconfig.TYPE_TO_STR[sym.type] != entry.type:
-            diag = Diagnostic.err(f'Invalid type. Expected {kconfig.TYPE_TO_STR[sym.type]}',
+        # Symbol.type is computed on every access:
+        sym_type = sym.type
+        if sym_type != entry.kind:
+            diag = Diagnostic.err(f'Invalid type. Expected {kconfig.TYPE_TO_STR[sym_type]}',
                                   entry.full_range)
 
             # Add action to convert between hex and int:
-            if sym.type in [kconfig.HEX, kconfig.INT] and (entry.is_hex() or entry.is_int()):
-                action = CodeAction('Convert value to ' + str(kconfig.TYPE_TO_STR[sym.type]))
-                if sym.type == kconfig.HEX:
+            if sym_type in [kconfig.HEX, kconfig.INT] and entry.kind in [kconfig.HEX, kconfig.INT]:
+                action = CodeAction('Convert value to ' + str(kconfig.TYPE_TO_STR[sym_type]))
+                if sym_type == kconfig.HEX:
                     action.edit.add(entry.loc.uri, TextEdit(entry.value_range, hex(entry.value)))
                 else:
                     action.edit.add(entry.loc.uri, TextEdit(entry.value_range, str(entry.value)))
@@ -679,17 +1056,18 @@ class KconfigContext:
     def check_assignment(self, file: ConfFile, entry: ConfEntry, sym: kconfig.Symbol):
         """Check that the assigned value actually was propagated."""
         user_value = sym.user_value
-        if sym.type in [kconfig.BOOL, kconfig.TRISTATE]:
+        if sym.orig_type in [kconfig.BOOL, kconfig.TRISTATE]:
             user_value = kconfig.TRI_TO_STR[user_value]
 
         actions = []
-        if user_value == sym.str_value:
+        str_value = sym.str_value
+        if user_value == str_value:
             if user_value == 'y':
                 return
             msg = f'CONFIG_{sym.name} was already disabled.'
             severity = Diagnostic.HINT
-        elif len(sym.str_value):
-            msg = f'CONFIG_{sym.name} was assigned the value {entry.raw}, but got the value {sym.str_value}.'
+        elif len(str_value):
+            msg = f'CONFIG_{sym.name} was assigned the value {entry.raw}, but got the value {str_value}.'
             severity = Diagnostic.WARNING
         else:
             msg = f'CONFIG_{sym.name} couldn\'t be set.'
@@ -703,8 +1081,7 @@ class KconfigContext:
 
             for dep in deps:
                 if isinstance(dep, kconfig.Symbol) and dep.type == kconfig.BOOL:
-                    dep_entry = next((entry for entry in file.entries() if entry.name == dep.name),
-                                     None)
+                    dep_entry = next(iter(file.find(dep.name)), None)
                     if dep_entry:
                         edits.append({
                             'dep': dep.name,
@@ -765,8 +1142,7 @@ class KconfigContext:
             return True
 
     def check_multiple_assignments(self, file: ConfFile, entry: ConfEntry,
-                                   all_entries: List[ConfEntry]):
-        matching = [e for e in all_entries if e.name == entry.name]
+                                   matching: List[ConfEntry]):
         if len(matching) > 1 and matching[0] != entry:
             existing = matching[0]
             diag = Diagnostic.warn(
@@ -792,33 +1168,34 @@ class KconfigContext:
         generate_config.py that show up during the build, as these aren't
         part of kconfig.
         """
-        all_entries = self.all_entries()
+        by_name: Dict[str, List[ConfEntry]] = {}
+        for entry in self.all_entries():
+            by_name.setdefault(entry.name, []).append(entry)
+
+        # Resolve the lookups once, instead of for every entry.
+        # The checks run in order, and the first failing check ends the linting of an entry:
+        syms = self._kconfig.syms
+        checks = (self.check_undefined, self.check_type, self.check_assignment,
+                  self.check_visibility, self.check_defaults)
+
         for file in self.conf_files:
-            entries = file.entries()
-            for entry in entries:
-                if not entry.name in self._kconfig.syms:
+            for entry in file.entries():
+                sym: Optional[kconfig.Symbol] = syms.get(entry.name)
+                if sym is None:
                     continue
 
-                sym: kconfig.Symbol = self._kconfig.syms[entry.name]
-                if self.check_undefined(file, entry, sym):
-                    continue
-                if self.check_type(file, entry, sym):
-                    continue
-                if self.check_assignment(file, entry, sym):
-                    continue
-                if self.check_visibility(file, entry, sym):
-                    continue
-                if self.check_defaults(file, entry, sym):
-                    continue
-                if self.check_multiple_assignments(file, entry, all_entries):
+                if any(check(file, entry, sym) for check in checks):
                     continue
 
+                self.check_multiple_assignments(file, entry, by_name[entry.name])
+
     def load_config(self):
         """Load configuration files and update the diagnostics"""
         if not self.valid:
             pass
 
         try:
+            self._values_changed()
             self._kconfig.load_config(self.board.conf_file.uri.path, replace=True)
 
             for file in self.conf_files:
@@ -853,7 +1230,7 @@ class KconfigContext:
 
         word = doc.word_at(pos)
         if word:
-            if re.match(r'Kconfig.*', uri.basename):
+            if uri.basename.startswith('Kconfig'):
                 return self.get(word)
 
             if word.startswith('CONFIG_'):
@@ -880,21 +1257,48 @@ class KconfigServer(LSPServer):
         self.main_uri = None
         self.access_count = 0
         self.ctx: Dict[str, KconfigContext] = {}
+        # Contexts by the path of their build directory, for matching file change events:
+        self._ctx_by_root: Dict[str, KconfigContext] = {}
+        self.diag_delay = DIAG_DELAY
+        self.completion_delay = COMPLETION_DELAY
+        self.invalidate_delay = INVALIDATE_DELAY
+        # Contexts to invalidate after the current burst of file changes, mapped to whether
+        # their sources can be checked against the previous parse:
+        self._pending_invalidations: Dict[KconfigContext, bool] = {}
+        # Encoded diagnostics last published for each URI:
+        self._last_published: Dict[str, bytes] = {}
+        # Contexts using each conf file, cleared when the set of contexts changes:
+        self._conf_file_ctxs: Dict[str, List[KconfigContext]] = {}
+        # Last complete completion response for each context, along with its prefix:
+        self._completion_cache: Dict[str, Tuple[str, Dict[str, Any]]] = {}
         self.dbg('Python version: ' + sys.version)
 
     def publish_diags(self, uri, diags: List[Diagnostic]):
-        """Send a diagnostics publication notification"""
-        self.notify('textDocument/publishDiagnostics', {
-            'uri': uri,
-            'diagnostics': diags,
-        })
+        """
+        Send a diagnostics publication notification.
+
+        Skips the notification if the diagnostics are unchanged since the last publication
+        for the same URI.
+        """
+        encoded = encode_json(diags)
+        if self._last_published.get(str(uri)) == encoded:
+            return
+        self._last_published[str(uri)] = encoded
+
+        # Reuse the encoded diagnostics instead of encoding them again:
+        self.notify_encoded('textDocument/publishDiagnostics',
+                            b'{"uri":' + encode_json(str(uri)) + b',"diagnostics":' + encoded + b'}')
 
     def refresh_ctx(self, ctx: KconfigContext):
         """Reparse the given Kconfig context, and publish diagsnostics"""
+        self._completion_cache.pop(str(ctx.uri), None)
         ctx.clear_diags()
         if not ctx.valid:
-            self.dbg('Parsing...')
-            ctx.parse()
+            if ctx.revalidate():
+                self.dbg('Kconfig sources unchanged, skipped parsing.')
+            else:
+                self.dbg('Parsing...')
+                ctx.parse()
 
         if ctx.valid:
             self.dbg('Load config...')
@@ -904,12 +1308,18 @@ class KconfigServer(LSPServer):
                 sum([len(file.diags) for file in ctx.all_conf_files]),
                 len(ctx._kconfig.warnings if ctx._kconfig else 0)))
 
+        # Several sources may report diagnostics for the same file.
+        # Merge them, so each file gets a single publication:
+        merged: Dict[str, List[Diagnostic]] = {}
         for conf in ctx.all_conf_files:
-            self.publish_diags(conf.uri, conf.diags)
+            merged.setdefault(str(conf.uri), []).extend(conf.diags)
 
-        self.publish_diags(Uri.file('command-line'), ctx.cmd_diags)
+        merged.setdefault(str(Uri.file('command-line')), []).extend(ctx.cmd_diags)
 
         for uri, diags in ctx.kconfig_diags.items():
+            merged.setdefault(str(uri), []).extend(diags)
+
+        for uri, diags in merged.items():
             self.publish_diags(uri, diags)
 
     def create_ctx(self, uri: Uri, root, conf_files, env):
@@ -921,7 +1331,16 @@ class KconfigServer(LSPServer):
         self.dbg(f'Creating context {uri}')
         ctx = KconfigContext(uri, root, conf_files, env)
 
+        replaced = self.ctx.get(str(uri))
+        if replaced:
+            # Don't refresh or complete from the replaced context:
+            self.cancel(f'refresh:{uri}')
+            self._pending_invalidations.pop(replaced, None)
+            self._completion_cache.pop(str(uri), None)
+
         self.ctx[str(uri)] = ctx
+        self._ctx_by_root[uri.path] = ctx
+        self._conf_file_ctxs.clear()
         return ctx
 
     def sorted_contexts(self):
@@ -939,6 +1358,9 @@ class KconfigServer(LSPServer):
         Keeps track of the currently referenced context, and will prefer
         this if it owns the given URI.
         """
+        # Don't hand out contexts that are about to be invalidated:
+        self.flush_invalidations()
+
         is_conf_file = uri.basename.endswith('.conf')
 
         ctx = self.ctx.get(str(self.main_uri))
@@ -949,13 +1371,18 @@ class KconfigServer(LSPServer):
                 return ctx
 
         # Candidate contexts are all contexts that has the file:
-        def has_uri(ctx):
-            if is_conf_file:
-                return ctx.has_file(uri)
-            return True
+        candidates: Iterable[KconfigContext]
+        if is_conf_file:
+            cached = self._conf_file_ctxs.get(str(uri))
+            if cached is None:
+                cached = [c for c in self.ctx.values() if c.has_file(uri)]
+                self._conf_file_ctxs[str(uri)] = cached
+            candidates = cached
+        else:
+            candidates = self.ctx.values()
 
         # Get most recent candidate:
-        ctx = [None, *[c for c in self.sorted_contexts() if has_uri(c)]].pop()
+        ctx = [None, *sorted(candidates, key=lambda ctx: ctx.last_access)].pop()
 
         if ctx:
             self.access_count += 1
@@ -981,6 +1408,23 @@ class KconfigServer(LSPServer):
 
         return ctx.symbol_at(uri, Position.create(params['position']))
 
+    def schedule_refresh(self, ctx: KconfigContext):
+        """
+        Refresh the given context once the user stops making changes.
+
+        Every change restarts the delay, so a burst of changes results in a single refresh.
+        """
+        self.schedule(f'refresh:{ctx.uri}', self.diag_delay, lambda: self.refresh_ctx(ctx))
+
+    @handler('initialize')
+    def handle_initialize(self, params):
+        options = params.get('initializationOptions') or {}
+        if options.get('diagnosticDelay') is not None:
+            self.diag_delay = options['diagnosticDelay'] / 1000
+        if options.get('completionDelay') is not None:
+            self.completion_delay = options['completionDelay'] / 1000
+        return super().handle_initialize(params)
+
     @handler('initialized')
     def handle_initialized(self, params):
         self.watch_files('**/Kconfig*')
@@ -1002,7 +1446,15 @@ class KconfigServer(LSPServer):
     def handle_remove_build(self, params):
         uri = Uri.parse(params['uri'])
         if self.ctx.get(str(uri)):
-            del self.ctx[str(uri)]
+            ctx = self.ctx.pop(str(uri))
+            self._ctx_by_root.pop(ctx.uri.path, None)
+            self._conf_file_ctxs.clear()
+            self.cancel(f'refresh:{uri}')
+            # Forget the diagnostics published for the removed build:
+            for file in ctx.all_conf_files:
+                self._last_published.pop(str(file.uri), None)
+            for diag_uri in ctx.kconfig_diags:
+                self._last_published.pop(diag_uri, None)
             self.dbg('Deleted build ' + str(uri))
 
     @handler('kconfig/setMainBuild')
@@ -1039,7 +1491,7 @@ class KconfigServer(LSPServer):
     def handle_change(self, params):
         super().handle_change(params)
         if self.last_ctx:
-            self.refresh_ctx(self.last_ctx)
+            self.schedule_refresh(self.last_ctx)
 
     @handler('kconfig/getMenu')
     def handle_get_menu(self, params):
@@ -1060,6 +1512,7 @@ class KconfigServer(LSPServer):
         if not ctx:
             return
 
+        self._completion_cache.pop(str(ctx.uri), None)
         if 'val' in params:
             ctx.set(params['name'], params['val'])
         else:
@@ -1071,6 +1524,15 @@ class KconfigServer(LSPServer):
 
     @handler('textDocument/completion')
     def handle_completion(self, params):
+        # Clients request completions on every keystroke. Only compute the last one in a burst:
+        self.defer(f'completion:{params["textDocument"]["uri"]}', self.completion_delay,
+                   lambda: self.complete(params), {
+                       'isIncomplete': True,
+                       'items': []
+                   })
+
+    def complete(self, params):
+        """Get the completion list for a textDocument/completion request."""
         uri = Uri.parse(params['textDocument']['uri'])
         ctx = self.best_ctx(uri)
         if not ctx:
@@ -1095,51 +1557,38 @@ class KconfigServer(LSPServer):
             word = prefix.lstrip()
 
             if len(word) > 0:
-                # Ensure word starts with 'CONFIG_'. By using commonprefix, we can also detect and correct
-                # partial matches:
-                common = os.path.commonprefix([word, 'CONFIG_'])
-                if len(common) < len('CONFIG_'):
-                    word = 'CONFIG_' + word[len(common):]
+                # Ensure word starts with 'CONFIG_'. By counting the common prefix, we can also
+                # detect and correct partial matches:
+                common = 0
+                for a, b in zip(word, 'CONFIG_'):
+                    if a != b:
+                        break
+                    common += 1
+                if common < len('CONFIG_'):
+                    word = 'CONFIG_' + word[common:]
                 else:
                     show_non_visible = True
 
         else:
             word = None
 
-        def insert_text(sym: kconfig.Symbol):
-            insert = Snippet('CONFIG_')
-            insert.add_text(sym.name)
-            insert.add_text('=')
-            if sym.type in [kconfig.BOOL, kconfig.TRISTATE]:
-                choices = [kconfig.TRI_TO_STR[val] for val in list(sym.assignable)]
-                choices.reverse()  # sym.assignable shows 'n' first, but user normally wants 'y'
-                insert.add_choice(choices)
-            elif sym.type == kconfig.STRING:
-                insert.add_text('"')
-                insert.add_tabstop()
-                insert.add_text('"')
-            elif sym.type == kconfig.HEX:
-                insert.add_text('0x')
-            else:
-                pass  # freeform value
-
-            return insert.text
-
-        items = [{
-            'label':
-            'CONFIG_' + sym.name,
-            'kind':
-            CompletionItemKind.VARIABLE,
-            'detail':
-            kconfig.TYPE_TO_STR[sym.type],
-            'documentation':
-            next((n.help.replace('\n', ' ') for n in sym.nodes if n.help), ' '),
-            'insertText':
-            insert_text(sym),
-            'insertTextFormat':
-            InsertTextFormat.SNIPPET
-        } for sym in ctx.symbols(word) if sym.visibility or show_non_visible
-                 ]  # Only show visible symbols on completion without a prefix
+        if word is None:
+            # The list is discarded as soon as the user starts typing, so only return the first
+            # visible symbols. The list is incomplete, so the client requests a new one:
+            syms = ctx.symbols(None, visible_only=True)[:COMPLETION_LIMIT]
+            return {'isIncomplete': True, 'items': ctx.completion_items(syms)}
+
+        # A complete response contains every match for its prefix, so it also covers any
+        # longer prefix of a symbol name. The client does the remaining filtering. Repaired
+        # partial words only show visible symbols, so they can't use it:
+        if show_non_visible:
+            cached = self._completion_cache.get(str(ctx.uri))
+            if (cached and word.startswith(cached[0])
+                    and _SYM_NAME_RE.fullmatch(word, len(cached[0]))):
+                return cached[1]
+
+        # Only show visible symbols on completion without a prefix:
+        items = ctx.completion_items(ctx.symbols(word, visible_only=not show_non_visible))
 
         self.dbg('Filter: "{}" Total symbols: {} Results: {}'.format(word,
                                                                      len(ctx._kconfig.syms.items()),
@@ -1147,7 +1596,10 @@ class KconfigServer(LSPServer):
         # When performing a completion request without any prefix, we'll only show the visible symbols.
         # Since we want to start showing users non-visible symbols when they start typing, we need
         # to mark the non-prefixed completion list incomplete to make the client re-requests a new list
-        return {'isIncomplete': not show_non_visible, 'items': items}
+        result = {'isIncomplete': not show_non_visible, 'items': items}
+        if show_non_visible:
+            self._completion_cache[str(ctx.uri)] = (word, result)
+        return result
 
     @handler('textDocument/definition')
     def handle_definition(self, params):
@@ -1170,30 +1622,19 @@ class KconfigServer(LSPServer):
         if not sym:
             return
 
-        contents = MarkupContent('')
-
-        prompt = _prompt(sym, True)
-        if prompt:
-            contents.add_text(prompt)
-
-        contents.paragraph()
-        contents.add_markdown('Type: `{}`'.format(kconfig.TYPE_TO_STR[sym.type]))
-        if len(sym.str_value) > 0:
-            contents.linebreak()
-            contents.add_markdown('Value: `{}`'.format(sym.str_value))
-        contents.paragraph()
-
-        help = '\n\n'.join([n.help.replace('\n', ' ') for n in sym.nodes if n.help])
-        if help:
-            contents.add_text(help)
+        # Hover requests follow the cursor, so build the markdown in one go:
+        prompt = MarkupContent.sanitize(_prompt(sym, True) or '')
+        type = kconfig.TYPE_TO_STR[sym.type]
+        str_value = sym.str_value
+        value = f'\n\nValue: `{str_value}`' if str_value else ''
+        _, help = ctx.help(sym)
+        md = f'{prompt}\n\nType: `{type}`{value}\n\n{MarkupContent.sanitize(help)}'
 
         if not uri.basename.endswith('.conf') and len(ctx.conf_files) != 0:
-            contents.paragraph()
-            contents.add_markdown('_Kconfig environment: [{}]({})_'.format(
-                os.path.relpath(ctx.uri.path, os.path.join(ctx.uri.path, '..', '..')),
-                ctx.conf_files[0].uri))
+            env = os.path.relpath(ctx.uri.path, os.path.join(ctx.uri.path, '..', '..'))
+            md += f'\n\n_Kconfig environment: [{env}]({ctx.conf_files[0].uri})_'
 
-        return {'contents': contents}
+        return {'contents': MarkupContent.markdown(md)}
 
     @handler('textDocument/documentSymbol')
     def handle_doc_symbols(self, params):
@@ -1206,15 +1647,7 @@ class KconfigServer(LSPServer):
         if not file:
             return
 
-        def doc_sym(e: ConfEntry):
-            sym = ctx.get(e.name)
-            if sym:
-                prompt = _prompt(sym, True)
-            else:
-                prompt = None
-            return DocumentSymbol('CONFIG_' + e.name, SymbolKind.PROPERTY, e.full_range, prompt)
-
-        return [doc_sym(e) for e in file.entries()]
+        return file.doc_symbols(ctx)
 
     @handler('workspace/symbol')
     def handle_workspace_symbols(self, params):
@@ -1224,7 +1657,7 @@ class KconfigServer(LSPServer):
             return
 
         def sym_info(sym: kconfig.Symbol):
-            return SymbolInformation('CONFIG_' + sym.name, SymbolKind.PROPERTY,
+            return SymbolInformation(ctx.config_name(sym.name), SymbolKind.PROPERTY,
                                      _loc(sym)[0], _prompt(sym, True))
 
         return [sym_info(s) for s in ctx.symbols(query) if len(s.nodes)]
@@ -1247,23 +1680,49 @@ class KconfigServer(LSPServer):
 
         range: Range = Range.create(params['range'])
         actions = []
-        for diag in conf.diags:
-            if range.overlaps(diag.range):
-                actions.extend(diag.actions)
+        for diag in conf.diags_in(range):
+            actions.extend(diag.actions)
 
         return actions
 
+    def flush_invalidations(self):
+        """Invalidate the contexts affected by file changes since the last flush."""
+        self.cancel('invalidate')
+        pending = self._pending_invalidations
+        self._pending_invalidations = {}
+        for ctx, check_sources in pending.items():
+            ctx.invalidate(check_sources)
+            self.dbg(f'Invalidated {ctx} because of file changes')
+
+    def _queue_invalidation(self, ctx: KconfigContext, check_sources: bool):
+        # Sources can only be checked if every change in the burst allows it:
+        pending = self._pending_invalidations
+        pending[ctx] = pending.get(ctx, True) and check_sources
+
     def on_file_change(self, uri: Uri, kind: FileChangeKind):
+        # Created and deleted files may change which files the Kconfig tree includes,
+        # so only changes to existing files can be checked against the previous parse:
+        check_sources = kind == FileChangeKind.CHANGED
+        path = uri.path
         if uri.basename.startswith('Kconfig'):
+            self._completion_cache.clear()
+            self._conf_file_ctxs.clear()
             for ctx in self.ctx.values():
-                ctx.invalidate()
-                self.dbg(f'Invalidated context because of change in {uri}')
-        elif uri.basename == 'edt.pickle':
+                self._queue_invalidation(ctx, check_sources)
+        elif path.endswith(_EDT_PICKLE_SUFFIX):
             # When the DTS context for this context changes, it should be invalidated:
-            changedCtx = self.ctx.get(str(Uri.file(uri.path.replace('/zephyr/edt.pickle', ''))))
+            changedCtx = self._ctx_by_root.get(path[:-len(_EDT_PICKLE_SUFFIX)])
             if changedCtx:
-                changedCtx.invalidate()
-                self.dbg(f'Invalidated {changedCtx} due to dts changes.')
+                self._completion_cache.pop(str(changedCtx.uri), None)
+                self._conf_file_ctxs.clear()
+                self._queue_invalidation(changedCtx, check_sources)
+                self.dbg(f'Invalidating {changedCtx} due to dts changes.')
+        else:
+            return
+
+        # Checkouts and build system runs change many files at once. Wait for the burst to end
+        # before invalidating, so each context is only invalidated once:
+        self.schedule('invalidate', self.invalidate_delay, self.flush_invalidations)
 
 
 def wait_for_debugger():
@@ -5,6 +5,9 @@
 import os
 import re
 import enum
+import bisect
+import functools
+import itertools
 from typing import Any, Callable, Optional, List, Dict
 from rpc import RPCServer, RPCResponse, handler
 """
@@ -14,6 +17,18 @@ This file implements the language server protocol, including a document store,
 a language server and all the required surrounding classes.
 """
 
+_URI_RE = re.compile(r'(.*?):(?://([^?\s/#]*))?(/[^?\s]*)?(?:\?([^#]+))?(?:#(.+))?')
+# Percent encoded characters, like %3A:
+_PCT_RE = re.compile(r'%([\da-fA-F]{2})')
+_WIN_PATH_RE = re.compile(r'\w:\\')
+_WIN_URI_PATH_RE = re.compile(r'^/(\w:/)')
+# Escapes for markdown syntax characters in plaintext:
+_MD_ESCAPES = str.maketrans({
+    **{c: '\\' + c for c in '`{}[]'},
+    '<': '&lt;',
+    '>': '&gt;',
+})
+
 
 class Uri:
     """
@@ -28,6 +43,8 @@ class Uri:
             |           |            |            |        |
         scheme     authority       path        query   fragment
     """
+    __slots__ = ('scheme', 'authority', 'path', 'query', 'fragment', '_str')
+
     def __init__(self,
                  scheme: str,
                  authority: str = '',
@@ -52,10 +69,12 @@ class Uri:
         """
         self.scheme = scheme or ''
         self.authority = authority or ''
-        path = re.sub(r'^/(\w:/)', r'\1', path)
+        path = _WIN_URI_PATH_RE.sub(r'\1', path)
         self.path = path or ''
         self.query = query or ''
         self.fragment = fragment or ''
+        # String form, built on first use:
+        self._str: Optional[str] = None
 
     def escape(self, text):
         def escape_char(c):
@@ -66,6 +85,10 @@ class Uri:
         return ''.join([escape_char(c) for c in text])
 
     def __repr__(self):
+        # Uris aren't modified after they're created, so the string form can be reused:
+        if self._str is not None:
+            return self._str
+
         path = self.path
         if not path.startswith('/'):
             path = '/' + path
@@ -75,6 +98,7 @@ class Uri:
             uri += '?' + self.query
         if self.fragment:
             uri += '#' + self.fragment
+        self._str = uri
         return uri
 
     def __str__(self):
@@ -85,7 +109,10 @@ class Uri:
             return Uri.parse(o) == self
         if not isinstance(o, Uri):
             return NotImplemented
-        return str(self) == str(o)
+        return self.__repr__() == o.__repr__()
+
+    def __hash__(self):
+        return hash(self.__repr__())
 
     @property
     def basename(self):
@@ -94,25 +121,16 @@ class Uri:
 
     @staticmethod
     def parse(raw: str):
-        """Parse a URI from a raw string"""
-        def sanitize(part):
-            if part:
-                return re.sub(r'%([\da-fA-F]{2})', lambda x: chr(int(x.group(1), 16)), part)
-            else:
-                return ''
+        """
+        Parse a URI from a raw string.
 
+        The same URIs are parsed over and over, so the results are cached. Uri objects are
+        never modified after they're created, so parsed URIs can safely be shared.
+        """
         if not isinstance(raw, str):
             return NotImplemented
 
-        sanitized = sanitize(raw)
-
-        # Convert windows paths:
-        if re.match(r'\w:\\', sanitized):
-            sanitized = 'file:///' + sanitized.replace('\\', '/')
-
-        match = re.match(r'(.*?):(?://([^?\s/#]*))?(/[^?\s]*)?(?:\?([^#]+))?(?:#(.+))?', sanitized)
-        if match:
-            return Uri(*list(match.groups()))
+        return _parse_uri(raw)
 
     @staticmethod
     def file(path: str):
@@ -123,6 +141,20 @@ class Uri:
         return str(self)
 
 
+@functools.lru_cache(maxsize=4096)
+def _parse_uri(raw: str) -> Optional[Uri]:
+    sanitized = _PCT_RE.sub(lambda x: chr(int(x.group(1), 16)), raw)
+
+    # Convert windows paths:
+    if _WIN_PATH_RE.match(sanitized):
+        sanitized = 'file:///' + sanitized.replace('\\', '/')
+
+    match = _URI_RE.match(sanitized)
+    if match:
+        return Uri(*match.groups())
+    return None
+
+
 class WorkspaceFolder:
     """
     Workspace folder representation.
@@ -133,6 +165,8 @@ class WorkspaceFolder:
 
 
 class Position:
+    __slots__ = ('line', 'character')
+
     def __init__(self, line: int, character: int):
         """
         TextDocument position, as a zero-indexed line and character.
@@ -188,6 +222,9 @@ class Position:
     def __repr__(self):
         return '{}:{}'.format(self.line + 1, self.character)
 
+    def to_dict(self):
+        return {'line': self.line, 'character': self.character}
+
     @staticmethod
     def create(obj):
         """Create position from a serialized object."""
@@ -205,6 +242,8 @@ class Position:
 
 
 class Range:
+    __slots__ = ('start', 'end')
+
     def __init__(self, start: Position, end: Position):
         """
         TextDocument range.
@@ -254,10 +293,17 @@ class Range:
     def __repr__(self):
         return '{} - {}'.format(self.start, self.end)
 
+    def to_dict(self):
+        return {'start': self.start.to_dict(), 'end': self.end.to_dict()}
+
     @staticmethod
     def create(obj):
         """Create a range from a serialized object."""
-        return Range(Position.create(obj['start']), Position.create(obj['end']))
+        # Ranges are parsed for every change and request, so build the positions inline:
+        start = obj['start']
+        end = obj['end']
+        return Range(Position(start['line'], start['character']),
+                     Position(end['line'], end['character']))
 
 
 class Location:
@@ -266,6 +312,8 @@ class Location:
 
     A location object represents a unique text range in a resource in a workspace.
     """
+    __slots__ = ('uri', 'range')
+
     def __init__(self, uri: Uri, range: Range):
         self.uri = uri
         self.range = range
@@ -273,6 +321,9 @@ class Location:
     def __repr__(self):
         return '{}: {}'.format(self.uri, self.range)
 
+    def to_dict(self):
+        return {'uri': str(self.uri), 'range': self.range.to_dict()}
+
     def __eq__(self, other):
         if not isinstance(other, Location):
             return NotImplemented
@@ -318,10 +369,16 @@ class TextDocument:
         self.languageId = languageId
         self.version = version
         self.modified = version != 0
+        self.revision = 0
         self._inside = False
         self._mode = None
         self._scanpos = 0
         self.lines: List[str] = []
+        self._text = ''
+        self._text_revision = -1
+        # Offset of the start of each line, and the end of the last line:
+        self._line_starts: List[int] = [0]
+        self._line_starts_revision = 0
         self._cbs: List[Callable[['TextDocument'], Any]] = []
         self._virtual = self.uri.scheme != 'file'
         self.loaded = False
@@ -341,15 +398,34 @@ class TextDocument:
 
     def _set_text(self, text):
         """Internal: Replace the contents of the document."""
-        self.lines = text.splitlines()
+        self._set_lines(text.splitlines())
+
+    def _set_lines(self, lines: List[str]):
+        """Internal: Replace the lines of the document."""
+        self.lines = lines
         self.loaded = True
+        # The client controlled version isn't updated for internal changes, so keep a separate
+        # change counter that users of the document can use to invalidate derived data:
+        self.revision += 1
         for cb in self._cbs:
             cb(self)
 
     @property
     def text(self):
         """Full contents of the document, using newline as a line separator."""
-        return '\n'.join(self.lines) + '\n'
+        # The stream functions access the text repeatedly, so only join the lines once per change:
+        if self._text_revision != self.revision:
+            self._text = '\n'.join(self.lines) + '\n'
+            self._text_revision = self.revision
+        return self._text
+
+    @property
+    def line_starts(self) -> List[int]:
+        """Content offset of the start of each line, followed by the offset past the last line."""
+        if self._line_starts_revision != self.revision:
+            self._line_starts = [0, *itertools.accumulate(len(l) + 1 for l in self.lines)]
+            self._line_starts_revision = self.revision
+        return self._line_starts
 
     def line(self, index):
         """Get the contents of a line in the document. Does not include the line separator."""
@@ -364,21 +440,39 @@ class TextDocument:
         if pos.line >= len(self.lines):
             return len(self.text)
         character = min(len(self.lines[pos.line]) + 1, pos.character)
-        return len(''.join([l + '\n' for l in self.lines[:pos.line]])) + character
+        return self.line_starts[pos.line] + character
 
     def pos(self, offset: int):
-        """Get the Position at the given content offset."""
-        content = self.text[:offset]
-        lines = content.splitlines()
-        if len(lines) == 0:
-            return Position(0, 0)
-        return Position(len(lines) - 1, len(lines[-1]))
+        """
+        Get the Position at the given content offset.
+
+        Offsets past the last line break are clamped to the end of the last line.
+        """
+        starts = self.line_starts
+        if offset >= starts[-1]:
+            if not self.lines:
+                return Position(0, 0)
+            return Position(len(self.lines) - 1, len(self.lines[-1]))
+        line = bisect.bisect_right(starts, max(offset, 0)) - 1
+        return Position(line, max(offset, 0) - starts[line])
 
     def get(self, range: Range = None):
         """Get the text in the given range."""
         if not range:
             return self.text
-        text = self.text[self.offset(range.start):self.offset(range.end)]
+
+        # Slice the lines in the range, instead of the full text:
+        start_line, start_char = self._line_pos(range.start)
+        end_line, end_char = self._line_pos(range.end)
+        lines = self.lines
+        if (start_line, start_char) >= (end_line, end_char):
+            text = ''
+        elif start_line == end_line:
+            text = lines[start_line][start_char:end_char]
+        else:
+            parts = [lines[start_line][start_char:], *lines[start_line + 1:end_line]]
+            parts.append(lines[end_line][:end_char] if end_line < len(lines) else '')
+            text = '\n'.join(parts)
 
         # Trim trailing newline if the range doesn't end on the next line:
         if text.endswith('\n') and range.end.character != 0 and range.end.line < len(self.lines):
@@ -392,10 +486,14 @@ class TextDocument:
         """
         line = self.line(pos.line)
         if line:
-            before = re.match(r'.*?(\w*)$', line[:pos.character])
-            after = re.match(r'^\w*', line[pos.character:])
-            if before and after:
-                return before[1] + after[0]
+            # Scan outwards from the position while the characters match \w:
+            end = min(pos.character, len(line))
+            start = end
+            while start > 0 and (line[start - 1].isalnum() or line[start - 1] == '_'):
+                start -= 1
+            while end < len(line) and (line[end].isalnum() or line[end] == '_'):
+                end += 1
+            return line[start:end]
 
     def replace(self, text: str, range: Range = None):
         """
@@ -410,12 +508,49 @@ class TextDocument:
         """
         # Ignore range if the file is empty:
         if range and len(self.lines) > 0:
-            self._set_text(self.text[:self.offset(range.start)] + text +
-                           self.text[self.offset(range.end):])
+            start = self._line_pos(range.start)
+            end = self._line_pos(range.end)
+            if start <= end:
+                self._splice(start, end, text)
+            else:
+                self._set_text(self.text[:self.offset(range.start)] + text +
+                               self.text[self.offset(range.end):])
         else:
             self._set_text(text)
         self.modified = True
 
+    def _line_pos(self, pos: Position):
+        """
+        Internal: Get the line and character of the given position, clamped like offset().
+
+        Positions past the end of a line point to the start of the next line, and positions
+        past the last line point to the end of the document, as (len(self.lines), 0).
+        """
+        if pos.line >= len(self.lines):
+            return len(self.lines), 0
+        if pos.character > len(self.lines[pos.line]):
+            return pos.line + 1, 0
+        return pos.line, pos.character
+
+    def _splice(self, start, end, text: str):
+        """
+        Internal: Replace the text between two line positions from _line_pos().
+
+        Only the lines touched by the replacement are split again, so edits don't have to
+        rebuild the entire document.
+        """
+        start_line, start_char = start
+        end_line, end_char = end
+        lines = self.lines
+        if end_line < len(lines):
+            # The rest of the end line, including its line break:
+            suffix = lines[end_line][end_char:] + '\n'
+        else:
+            suffix = ''
+        prefix = lines[start_line][:start_char] if start_line < len(lines) else ''
+        self._set_lines(lines[:start_line] + (prefix + text + suffix).splitlines() +
+                        lines[end_line + 1:])
+
     def _write_to_disk(self):
         """Internal: Store the file on disk. The document's must use the `file` scheme."""
         if not self._virtual:
@@ -535,7 +670,11 @@ class TextDocument:
 
         if self._scanpos >= len(self.text):
             return ''
-        out = self.text[self._scanpos:].splitlines(True)[0]
+        # Read to the start of the next line:
+        starts = self.line_starts
+        line = bisect.bisect_right(starts, self._scanpos) - 1
+        end = starts[line + 1] if line + 1 < len(starts) else len(self.text)
+        out = self.text[self._scanpos:end]
         if size != None:
             out = out[:size]
         self._scanpos += len(out)
@@ -548,7 +687,13 @@ class TextDocument:
 
         if self._scanpos >= len(self.text):
             return []
-        out = self.text[self._scanpos:].splitlines()
+        starts = self.line_starts
+        line = bisect.bisect_right(starts, self._scanpos) - 1
+        if line < len(self.lines):
+            # The rest of the current line, followed by the remaining lines:
+            out = [self.lines[line][self._scanpos - starts[line]:], *self.lines[line + 1:]]
+        else:
+            out = self.text[self._scanpos:].splitlines()
         self._scanpos = len(self.text)
         return out
 
@@ -610,12 +755,12 @@ class DocumentStore:
     The DocumentStore is instantiated as a singleton, which is referenced from the LSPServer.
     """
     def __init__(self):
-        self.docs: Dict[str, TextDocument] = {}
+        self.docs: Dict[Uri, TextDocument] = {}
         self._providers: Dict[str, DocProvider] = {}
 
     def open(self, doc: TextDocument):
         """Register the given document in the document store."""
-        self.docs[str(doc.uri)] = doc
+        self.docs[doc.uri] = doc
 
     def close(self, uri: Uri):
         """Close the given URI in the document store."""
@@ -623,7 +768,7 @@ class DocumentStore:
 
     def provider(self, provider):
         """Register a DocumentProvider for a specific URI scheme."""
-        self._providers[provider.uri.scheme] = provider
+        self._providers[provider.scheme] = provider
 
     def reset(self):
         """
@@ -647,8 +792,9 @@ class DocumentStore:
         if uri.scheme in self._providers:
             return self._providers[uri.scheme].get(uri)
 
-        if str(uri) in self.docs:
-            return self.docs[str(uri)]
+        doc = self.docs.get(uri)
+        if doc is not None:
+            return doc
 
         try:
             if create:
@@ -664,7 +810,7 @@ class DocumentStore:
         if text == None:
             return None
         doc = TextDocument(uri, text)
-        self.docs[str(uri)] = doc
+        self.docs[uri] = doc
         return doc
 
 
@@ -739,6 +885,9 @@ class DiagnosticRelatedInfo:
         self.location = loc
         self.message = message
 
+    def to_dict(self):
+        return {'location': self.location.to_dict(), 'message': self.message}
+
 
 class TextEdit:
     """
@@ -777,7 +926,7 @@ class WorkspaceEdit:
 
     def has_changes(self):
         """Check whether this WorkspaceEdit will make any changes to URIs in the workspace."""
-        return len([c for c in self.changes.values() if len(c) > 0]) > 0
+        return any(len(c) > 0 for c in self.changes.values())
 
 
 class CodeActionKind(enum.Enum):
@@ -823,7 +972,7 @@ class CodeAction:
             'kind': self.kind.value,
         }
         if self.command:
-            result['command'] = self.command,
+            result['command'] = self.command
         if self.data:
             result['data'] = self.data
         if len(self.diagnostics) > 0:
@@ -877,11 +1026,12 @@ class Diagnostic:
         return '{}: {}: {}'.format(self.range, Diagnostic.severity_str(self.severity), self.message)
 
     def to_dict(self):
-        obj = {"message": self.message, "range": self.range, "severity": self.severity}
+        # Diagnostics are published in bulk, so build plain objects the encoder won't call back for:
+        obj = {"message": self.message, "range": self.range.to_dict(), "severity": self.severity}
         if len(self.tags):
             obj['tags'] = self.tags
         if len(self.related_info):
-            obj['relatedInformation'] = [info.__dict__ for info in self.related_info]
+            obj['relatedInformation'] = [info.to_dict() for info in self.related_info]
 
         return obj
 
@@ -959,23 +1109,22 @@ class MarkupContent:
         self.value = value
         self.kind = kind if kind else MarkupContent.MARKDOWN
 
-    def _sanitize(self, text):
-        text = re.sub(r'[`{}\[\]]', r'\\\0', text)
-        text = re.sub(r'<', '&lt;', text)
-        text = re.sub(r'>', '&gt;', text)
-        return text
+    @staticmethod
+    def sanitize(text):
+        """Escape plaintext for use in markdown."""
+        return text.translate(_MD_ESCAPES)
 
     def add_text(self, text):
         """Add plaintext"""
         if self.kind == MarkupContent.MARKDOWN:
-            self.value += self._sanitize(text)
+            self.value += self.sanitize(text)
         else:
             self.value += text
 
     def add_markdown(self, md):
         """Add preformatted markdown. Will convert this to markdown content."""
         if self.kind == MarkupContent.PLAINTEXT:
-            self.value = self._sanitize(self.value)
+            self.value = self.sanitize(self.value)
             self.kind = MarkupContent.MARKDOWN
         self.value += md
 
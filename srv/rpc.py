@@ -2,13 +2,21 @@
 #
 # SPDX-License-Identifier: LicenseRef-Nordic-1-Clause
 
-import inspect
-from typing import Any, Callable, Union, Optional
+import contextlib
+from typing import Any, Callable, Dict, Union, Optional
 import sys
 import os
 import json
 import enum
+import threading
+import traceback
 from datetime import datetime
+
+try:
+    # orjson is considerably faster than the json module, but isn't required:
+    import orjson  # type: ignore[import]
+except ImportError:
+    orjson = None  # type: ignore[assignment]
 """
 Remote procedure call implementation.
 
@@ -24,14 +32,32 @@ else:
     # See https://stackoverflow.com/questions/49709309/prevent-python-prints-automatic-newline-conversion-to-crlf-on-windows
     LINE_ENDING = '\n'
 
+# Header of outgoing messages, formatted with the content length. The content type is optional,
+# and the default utf-8 encoded JSON is what's being sent:
+_SEND_HEADER = ('Content-Length: %d' + LINE_ENDING * 2).encode('ascii')
+
+
+def _encoder(obj):
+    # Only called for objects the JSON encoder doesn't know. Objects with a to_dict() should
+    # return plain values from it, so nested fields don't need more calls back into Python:
+    to_dict = getattr(obj, 'to_dict', None)
+    if to_dict:
+        return to_dict()
+    return obj.__dict__
+
+
+def encode_json(o) -> bytes:
+    """Encode an object as utf-8 JSON. Objects are encoded with their to_dict() or __dict__."""
+    if orjson:
+        return orjson.dumps(o, default=_encoder, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(o, default=_encoder).encode('utf-8')
 
-def encode_json(o):
-    def encoder(obj):
-        if hasattr(obj, 'to_dict'):
-            return obj.to_dict()
-        return obj.__dict__
 
-    return json.dumps(o, default=encoder)
+def decode_json(data: bytes):
+    """Decode utf-8 JSON."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 class RPCMsg:
@@ -48,14 +74,17 @@ class RPCMsg:
 
     @staticmethod
     def from_obj(obj):
+        """Create an RPC message from a decoded JSON object, looking up each field once."""
+        get = obj.get
         if 'id' in obj:
+            id = obj['id']
             if 'method' in obj:
-                return RPCRequest(obj['id'], obj['method'], obj.get('params'))
+                return RPCRequest(id, obj['method'], get('params'))
 
-            return RPCResponse(obj['id'], obj.get('result'),
-                               RPCError.create(obj['error']) if obj.get('error') else None)
+            error = get('error')
+            return RPCResponse(id, get('result'), RPCError.create(error) if error else None)
 
-        return RPCNotification(obj['method'], obj.get('params'))
+        return RPCNotification(obj['method'], get('params'))
 
 
 class RPCRequest(RPCMsg):
@@ -174,6 +203,65 @@ class RPCNotification(RPCMsg):
         self.params = params
 
 
+def _fileno(stream) -> Optional[int]:
+    """Get the file descriptor of a stream, or None if it isn't backed by one."""
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class _RecvBuffer:
+    def __init__(self, read: Callable[[int], bytes], chunk_size=65536):
+        """
+        Buffered reader for the incoming messages.
+
+        Reads whatever is available on the stream, up to chunk_size bytes at a time, and keeps
+        the leftovers for the next read. Headers and message contents are sliced out of the
+        buffer, instead of being read from the stream one line or message at a time.
+
+        Parameters
+        ----------
+        read: Callable
+            Function reading up to the given number of bytes, returning the data that is
+            available without blocking for more, like os.read() or BufferedReader.read1().
+        chunk_size: int
+            Max number of bytes to read from the stream at a time.
+        """
+        self._read = read
+        self._chunk_size = chunk_size
+        self._buf = bytearray()
+        self._pos = 0
+
+    def _fill(self):
+        chunk = self._read(self._chunk_size)
+        if not chunk:
+            raise EOFError('Input stream closed')
+        if self._pos:
+            # Drop the consumed data before growing the buffer:
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += chunk
+
+    def readline(self) -> bytes:
+        """Read a line, including the line ending."""
+        while True:
+            end = self._buf.find(b'\n', self._pos)
+            if end >= 0:
+                line = bytes(self._buf[self._pos:end + 1])
+                self._pos = end + 1
+                return line
+            self._fill()
+
+    def read(self, n: int) -> bytes:
+        """Read exactly n bytes."""
+        while len(self._buf) - self._pos < n:
+            self._fill()
+        data = bytes(self._buf[self._pos:self._pos + n])
+        self._pos += n
+        return data
+
+
 def handler(method: str):
     """
     RPC message handler attribute.
@@ -196,6 +284,20 @@ def handler(method: str):
 
 
 class RPCServer:
+    # Message handlers by method, shared by all instances of the class:
+    handlers: Dict[str, Callable[..., Any]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Collect the handlers when the class is created, with subclasses overriding their bases:
+        handlers = {}
+        for base in reversed(cls.__mro__):
+            for f in vars(base).values():
+                method = getattr(f, '_rsp_method', None)
+                if method:
+                    handlers[method] = f
+        cls.handlers = handlers
+
     def __init__(self, istream=None, ostream=None):
         """
         RPC Server class.
@@ -220,39 +322,196 @@ class RPCServer:
 
         Parameters
         ----------
-        istream: TextIO | None
+        istream: BinaryIO | None
             Input stream for the incoming data, or sys.stdin if None.
-        ostream: TextIO | None
+        ostream: BinaryIO | None
             Output stream for the incoming data, or sys.stdout if None.
         """
         self._send_stream = ostream if ostream else sys.stdout.buffer
         self._recv_stream = istream if istream else sys.stdin.buffer
+        # Talk to the standard streams through their file descriptors, skipping Python's buffers:
+        self._send_fd = None if ostream else _fileno(sys.stdout)
+        recv_fd = None if istream else _fileno(sys.stdin)
+        if recv_fd is not None:
+            self._recv_buffer = _RecvBuffer(lambda n: os.read(recv_fd, n))
+        else:
+            self._recv_buffer = _RecvBuffer(self._recv_stream.read1)
         self._req = None
         self.log_file = 'lsp.log'
         self.logging = False
+        # Log file handle, opened on the first write. Writes are buffered until the end of the
+        # current message batch, or the next flush_log():
+        self._log_fh = None
         self.running = True
-        self.handlers = {}
         self.requests = {}
         self.request_id = 0
-        for method_name, _ in inspect.getmembers(self.__class__):
-            method = getattr(self.__class__, method_name)
-            if hasattr(method, '_rsp_method'):
-                self.handlers[method._rsp_method] = method
+        # Message handling and scheduled callbacks are serialized through this lock:
+        self._lock = threading.RLock()
+        self._timers: Dict[str, threading.Timer] = {}
+        self._deferred: Dict[str, RPCRequest] = {}
+        # Outgoing messages held back until the end of the current batch:
+        self._send_buf = bytearray()
+        self._send_batch_depth = 0
+
+    def _write_log(self, prefix: str, lines):
+        """Internal: Write lines to the log file, without reporting them anywhere else."""
+        if not self.logging:
+            return
+        if not self._log_fh:
+            self._log_fh = open(self.log_file, 'a', buffering=65536)
+        self._log_fh.write(''.join([prefix + str(line) + '\n' for line in lines]))
+
+    def flush_log(self):
+        """Write any buffered log messages to the log file."""
+        if self._log_fh:
+            self._log_fh.flush()
 
     def dbg(self, *args):
         """Write a debug message to the log file."""
-        if self.logging:
-            with open(self.log_file, 'a') as f:
-                for line in args:
-                    f.write('dbg: ' + str(line) + '\n')
+        self._write_log('dbg: ', args)
 
     def log(self, *args):
         """Write an info message to the log file."""
         if self.logging:
-            sys.stderr.write('\n'.join(*args) + '\n')
-            with open(self.log_file, 'a') as f:
-                for line in args:
-                    f.write('inf: ' + str(line) + '\n')
+            sys.stderr.write('\n'.join([str(line) for line in args]) + '\n')
+            self._write_log('inf: ', args)
+
+    def schedule(self, key: str, delay: float, cb: Callable[[], Any]):
+        """
+        Schedule a callback to be called after a delay.
+
+        Any pending callback scheduled with the same key is cancelled, so calling schedule()
+        repeatedly within the delay results in a single call to the last callback. This can
+        be used to coalesce bursts of changes into one expensive operation.
+
+        The callback runs on a timer thread, but is never called concurrently with message
+        handlers or other scheduled callbacks. Exceptions raised by the callback are logged.
+
+        Parameters
+        ----------
+        key: str
+            Unique key for the callback.
+        delay: float
+            Delay in seconds. If the delay is 0 or less, the callback is called right away.
+        cb: Callable
+            Callback to call. Takes no parameters.
+        """
+        self.cancel(key)
+        if delay <= 0:
+            cb()
+            return
+
+        def run():
+            with self._batch_sends():
+                # The timer may have been cancelled while waiting for the lock:
+                if self._timers.get(key) is not timer:
+                    return
+                del self._timers[key]
+                try:
+                    cb()
+                except Exception:
+                    self.log('Scheduled callback "{}" failed:'.format(key), traceback.format_exc())
+
+        timer = threading.Timer(delay, run)
+        timer.daemon = True
+        self._timers[key] = timer
+        timer.start()
+
+    def cancel(self, key: str):
+        """Cancel a callback registered with schedule(), if it's still pending."""
+        with self._lock:
+            timer = self._timers.pop(key, None)
+            if timer:
+                timer.cancel()
+
+    def defer(self, key: str, delay: float, cb: Callable[[], Any], superseded=None):
+        """
+        Respond to the request currently being processed after a delay.
+
+        The callback is scheduled with schedule(), and its return value is issued as the
+        response to the request. Errors raised by the callback are reported like errors
+        raised by handlers. The handler's own return value is ignored.
+
+        If another request is deferred with the same key before the callback runs, the
+        pending request is superseded: It gets an immediate response with the given
+        superseded result, and its callback is never called.
+
+        Parameters
+        ----------
+        key: str
+            Unique key for the deferred request.
+        delay: float
+            Delay in seconds. If the delay is 0 or less, the request is responded to right away.
+        cb: Callable
+            Callback producing the result. Takes no parameters.
+        superseded: Any
+            Result to respond with if the request is superseded.
+        """
+        if not self._req:
+            raise Exception('No command')
+
+        req = self._req
+        self._req = None
+
+        previous = self._deferred.pop(key, None)
+        if previous:
+            self._send(RPCResponse(previous.id, superseded))
+        self._deferred[key] = req
+
+        def run():
+            if self._deferred.get(key) is not req:
+                return
+            del self._deferred[key]
+            result, error = self._invoke(cb)
+            self._send(RPCResponse(req.id, result, error))
+
+        self.schedule(key, delay, run)
+
+    @contextlib.contextmanager
+    def _batch_sends(self):
+        """
+        Internal: Hold the lock, and hold back outgoing messages until the end of the block.
+
+        Handlers often send several messages in a row, like diagnostics for each file. The held
+        back messages are written to the output stream in order, with a single write and flush.
+        The log is flushed along with them, so it's complete if the server is killed.
+        """
+        with self._lock:
+            self._send_batch_depth += 1
+            try:
+                yield
+            finally:
+                self._send_batch_depth -= 1
+                if self._send_batch_depth == 0:
+                    self._flush_send()
+                    self.flush_log()
+
+    def _flush_send(self):
+        """Internal: Write the held back outgoing messages to the output stream."""
+        if not self._send_buf:
+            return
+        data = bytes(self._send_buf)
+        self._send_buf.clear()
+        if self._send_fd is not None:
+            # os.write() may write less than the whole buffer:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self._send_fd, view):]
+        else:
+            self._send_stream.write(data)
+            self._send_stream.flush()
+
+    def _invoke(self, f: Callable[..., Any], *args):
+        """Internal: Call a handler function, and return its result and any error it raised."""
+        try:
+            return f(*args), None
+        except RPCError as e:
+            self.dbg('Failed with error ' + str(e))
+            return None, e
+        except Exception as e:
+            self.dbg('Failed with error ' + str(e))
+            return None, RPCError(RPCErrorCode.UNKNOWN_ERROR_CODE,
+                                  'Exception: "{}"'.format(e.args))
 
     def _read_headers(self):
         """Internal: Read RPC headers from the input stream"""
@@ -261,7 +520,7 @@ class RPCServer:
         while True:
             # Header is encoded in ascii:
             # https://microsoft.github.io/language-server-protocol/specifications/specification-current/#headerPart
-            line = self._recv_stream.readline().decode('ascii').strip()
+            line = self._recv_buffer.readline().decode('ascii').strip()
             if len(line) == 0:
                 return length, content_type
 
@@ -352,31 +611,54 @@ class RPCServer:
 
         self._send(RPCNotification(method, params))
 
+    def notify_encoded(self, method: str, params: bytes):
+        """
+        Issue a notification with parameters that are already encoded with encode_json().
+
+        Lets senders of large, repeated notifications reuse their encoded parameters, instead
+        of encoding them again as part of the message.
+
+        Parameters
+        ----------
+        method: str
+            Remote method to invoke.
+        params: bytes
+            utf-8 encoded JSON parameters for the method.
+        """
+        # Same layout as an encoded RPCNotification:
+        self._send_encoded(b'{"jsonrpc":' + encode_json(JSONRPC) + b',"method":' +
+                           encode_json(method) + b',"params":' + params + b'}')
+
     def _send(self, msg: RPCMsg):
         """Internal: Send an RPCMessage to the client"""
-        raw = encode_json(msg)
-        self.dbg('send: ' + raw)
-        self._send_stream.write(
-            LINE_ENDING.join([
-                'Content-Type: "application/vscode-jsonrpc; charset=utf-8"',
-                'Content-Length: ' + str(len(raw)), '', raw
-            ]).encode('utf-8'))
-        self._send_stream.flush()
+        self._send_encoded(encode_json(msg))
+
+    def _send_encoded(self, raw: bytes):
+        """Internal: Send an encoded RPCMessage to the client"""
+        # Subclasses may report debug messages as notifications, so only write these to the log:
+        if self.logging:
+            self._write_log('dbg: ', ['send: ' + raw.decode('utf-8')])
+        with self._lock:
+            self._send_buf += _SEND_HEADER % len(raw)
+            self._send_buf += raw
+            if self._send_batch_depth == 0:
+                self._flush_send()
 
     def _recv(self) -> Union[RPCNotification, RPCRequest, RPCResponse]:
         """Internal: Receive an RPCMessage from the recv_stream"""
         length, content_type = self._read_headers()
 
         # Only utf-8 encoding is supported:
-        data = self._recv_stream.read(length).decode('utf-8')
+        data = self._recv_buffer.read(length)
 
-        self.dbg('recv: {}'.format(data))
+        if self.logging:
+            self._write_log('dbg: ', ['recv: ' + data.decode('utf-8')])
 
         try:
-            obj = json.loads(data)
-        except json.JSONDecodeError as e:
+            obj = decode_json(data)
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
             raise Exception(
-                f'FATAL: Failed to decode command.\n\tContent-Length: {length}\n\tContent type: {content_type}\n\tData: {data}'
+                f'FATAL: Failed to decode command.\n\tContent-Length: {length}\n\tContent type: {content_type}\n\tData: {data.decode("utf-8", "replace")}'
             )
 
         return RPCMsg.from_obj(obj)
@@ -390,43 +672,34 @@ class RPCServer:
         For requests, the return value of the handler will be issued as a response, unless the
         handler calls self.rsp() manually.
         """
-        if isinstance(msg, RPCResponse):
-            handler = self.requests.get(msg.id)
-            if handler:
-                handler(msg)
-                del self.requests[msg.id]
-            return
-
-        if isinstance(msg, RPCRequest):
-            self._req = msg
-
-        self.dbg('{} Method: {}'.format(type(msg).__name__, msg.method))
-
-        if msg.method in self.handlers:
-            error = None
-            result = None
-            start = datetime.now()
-            try:
-                result = self.handlers[msg.method](self, msg.params)
-            except RPCError as e:
-                self.dbg('Failed with error ' + str(e))
-                error = e
-            except Exception as e:
-                self.dbg('Failed with error ' + str(e))
-                error = RPCError(RPCErrorCode.UNKNOWN_ERROR_CODE, 'Exception: "{}"'.format(e.args))
-
-            end = datetime.now()
-            self.dbg('Handled in {} us'.format((end - start).microseconds))
-
-            if self._req:
-                self.rsp(result, error)
-        else:
-            self.dbg('No handler for "{}"'.format(msg.method))
-            if self._req:
-                self.rsp(
-                    None,
-                    RPCError(RPCErrorCode.METHOD_NOT_FOUND,
-                             'Unknown method "{}"'.format(msg.method)))
+        with self._batch_sends():
+            if isinstance(msg, RPCResponse):
+                handler = self.requests.get(msg.id)
+                if handler:
+                    handler(msg)
+                    del self.requests[msg.id]
+                return
+
+            if isinstance(msg, RPCRequest):
+                self._req = msg
+
+            self.dbg('{} Method: {}'.format(type(msg).__name__, msg.method))
+
+            if msg.method in self.handlers:
+                start = datetime.now()
+                result, error = self._invoke(self.handlers[msg.method], self, msg.params)
+                end = datetime.now()
+                self.dbg('Handled in {} us'.format((end - start).microseconds))
+
+                if self._req:
+                    self.rsp(result, error)
+            else:
+                self.dbg('No handler for "{}"'.format(msg.method))
+                if self._req:
+                    self.rsp(
+                        None,
+                        RPCError(RPCErrorCode.METHOD_NOT_FOUND,
+                                 'Unknown method "{}"'.format(msg.method)))
 
     def loop(self):
         """
@@ -434,13 +707,13 @@ class RPCServer:
         The loop is only aborted if self.running is set to False,
         or a keyboard interrupt is received.
         """
-        if self.logging:
-            # Put a clear session separator in log file:
-            with open(self.log_file, 'a') as f:
-                f.write('=' * 80 + '\n')
+        # Put a clear session separator in log file:
+        self._write_log('', ['=' * 80])
 
         try:
             while self.running:
                 self.handle(self._recv())
         except KeyboardInterrupt:
             pass
+        finally:
+            self.flush_log()
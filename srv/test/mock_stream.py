@@ -27,6 +27,14 @@ class MockStream:
             self.input = self.input[n:]
         return retval
 
+    def read1(self, n=-1):
+        if len(self.input) == 0:
+            raise StreamEnd()
+
+        if n == -1 or n > len(self.input):
+            n = len(self.input)
+        return self.read(n)
+
     def readline(self):
         try:
             idx = self.input.index(b'\n')
@@ -2,7 +2,7 @@
 #
 # SPDX-License-Identifier: LicenseRef-Nordic-1-Clause
 
-from lsp import Position, Range, TextDocument, Uri
+from lsp import MarkupContent, Position, Range, TextDocument, Uri
 import os.path as path
 
 # Test the LSP TextDocument class and accompanying classes
@@ -16,6 +16,8 @@ def test_position():
         doc = TextDocument(Uri.file(test_file), f.read())
     assert doc.pos(0) == Position.start()
     assert doc.pos(138) == Position(1, 27)
+    assert doc.pos(doc.offset(Position(2, 0))) == Position(2, 0)  # start of line
+    assert doc.pos(len(doc.text) + 10) == Position(len(doc.lines) - 1, len(doc.lines[-1]))
     assert doc.offset(Position(0, 111)) == doc.offset(Position(0, 999))  # end of line
     assert doc.offset(Position(32, 0)) == doc.offset(Position(999, 0))  # end of file
     assert doc.word_at(Position(1, 29)) == 'Nullam'  # at " Nu|llam"
@@ -103,3 +105,12 @@ def test_line_iterator():
 
     for i, line in enumerate(doc):
         assert line == doc.lines[i]
+
+
+def test_markup_sanitize():
+    assert MarkupContent.sanitize('a `b` [c]{d} <e>') == 'a \\`b\\` \\[c\\]\\{d\\} &lt;e&gt;'
+
+    content = MarkupContent('')
+    content.add_text('[text]')
+    content.add_markdown(' `code`')
+    assert content.value == '\\[text\\] `code`'
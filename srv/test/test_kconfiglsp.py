@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: LicenseRef-Nordic-1-Clause
 
 from typing import List
+import time
 import kconfiglsp
 from os import path
 from pytest import fixture
@@ -62,7 +63,16 @@ def notify(name, params=None):
 
 
 def test_init():
-    rsp = request('initialize', {'rootUri': str(Uri.file(zephyr_root))})
+    rsp = request(
+        'initialize',
+        {
+            'rootUri': str(Uri.file(zephyr_root)),
+            # Refresh diagnostics and complete right away, so the tests don't have to wait:
+            'initializationOptions': {
+                'diagnosticDelay': 0,
+                'completionDelay': 0,
+            },
+        })
     assert rsp.error == None
 
     # Should report a basic set of features.
@@ -189,7 +199,7 @@ def test_completion():
             'textDocument': {
                 'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
             },
-            'position': Position(3, 0).__dict__,  # an empty line
+            'position': Position(3, 0).to_dict(),  # an empty line
         })
 
     # Should yield values that can be set:
@@ -209,7 +219,7 @@ def test_completion():
                 'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
             },
             'position': Position(0,
-                                 10).__dict__,  # @ CONFIG_TES, should yield CONFIG_TEST_* entries
+                                 10).to_dict(),  # @ CONFIG_TES, should yield CONFIG_TEST_* entries
         })
 
     # Should yield values that can be set:
@@ -220,6 +230,24 @@ def test_completion():
     ]
     assert rsp.result['isIncomplete'] == False
 
+    # Extending the prefix of a complete response:
+    rsp = request(
+        'textDocument/completion',
+        {
+            'textDocument': {
+                'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
+            },
+            'position': Position(0, 14).to_dict(),  # @ CONFIG_TEST_EN
+        })
+
+    # The client filters the remaining entries:
+    assert [i['label'] for i in rsp.result['items']] == [
+        'CONFIG_TEST_ENTRY1',
+        'CONFIG_TEST_ENTRY2',
+        'CONFIG_TEST_ENTRY3',
+    ]
+    assert rsp.result['isIncomplete'] == False
+
     # Partial CONFIG_ completion:
     rsp = request(
         'textDocument/completion',
@@ -227,7 +255,7 @@ def test_completion():
             'textDocument': {
                 'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
             },
-            'position': Position(0, 4).__dict__,  # @ CONF, should act like root completion
+            'position': Position(0, 4).to_dict(),  # @ CONF, should act like root completion
         })
 
     # Should yield values that can be set:
@@ -245,13 +273,102 @@ def test_completion():
             'textDocument': {
                 'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
             },
-            'position': Position(4, 18).__dict__,
+            'position': Position(4, 18).to_dict(),
         })
 
     assert [i['insertText'] for i in rsp.result['items']] == ['CONFIG_BT_MESH_DEBUG=${1}']
     assert rsp.result['isIncomplete'] == False
 
 
+def test_completion_cache():
+    test_parse_context()
+    # Keep the changes from refreshing the context, like a user typing in a burst:
+    srv.diag_delay = 10
+
+    def type_line(version, text, character):
+        notify(
+            'textDocument/didChange', {
+                'textDocument': {
+                    'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf'))),
+                    'version': version,
+                },
+                'contentChanges': [{
+                    'range': {
+                        'start': {
+                            'line': 3,
+                            'character': 0,
+                        },
+                        'end': {
+                            'line': 3,
+                            'character': 0,
+                        }
+                    },
+                    'text': text
+                }]
+            })
+        return request(
+            'textDocument/completion', {
+                'textDocument': {
+                    'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
+                },
+                'position': Position(3, character).to_dict(),
+            })
+
+    # A full prefix yields a complete list, including non-visible symbols:
+    rsp = type_line(1, 'CONFIG_T', 8)
+    assert 'CONFIG_TEST_ENTRY1' in [i['label'] for i in rsp.result['items']]
+    assert rsp.result['isIncomplete'] == False
+
+    # A repaired partial prefix on a fresh line only yields visible symbols:
+    rsp = type_line(2, 'TES\n', 3)
+    assert [i['label'] for i in rsp.result['items']] == [
+        'CONFIG_TEST_ENTRY2',
+        'CONFIG_TEST_ENTRY3',
+    ]
+    assert rsp.result['isIncomplete'] == True
+
+    # The cached list doesn't cover values after a cached prefix:
+    rsp = type_line(3, 'CONFIG_TEST_ENTRY2=\n', 19)
+    assert rsp.result['items'] == []
+
+    for key in list(srv._timers):
+        srv.cancel(key)
+
+
+def test_completion_debounce():
+    test_parse_context()
+    srv.completion_delay = 0.05
+
+    def complete(id, character):
+        srv.handle(
+            RPCRequest(
+                id, 'textDocument/completion', {
+                    'textDocument': {
+                        'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
+                    },
+                    'position': Position(0, character).to_dict(),
+                }))
+
+    io.output = b''  # flush
+    complete(100, 9)
+    complete(101, 10)
+
+    # The first request is superseded by the second, and gets an empty response right away:
+    rsp = io.recv()
+    assert rsp.id == 100
+    assert rsp.result == {'isIncomplete': True, 'items': []}
+    assert len(io.output) == 0
+
+    time.sleep(0.2)
+    rsp = io.recv()
+    assert rsp.id == 101
+    assert [i['label'] for i in rsp.result['items']] == [
+        'CONFIG_TEST_ENTRY1',
+        'CONFIG_TEST_ENTRY2',
+        'CONFIG_TEST_ENTRY3',
+    ]
+
+
 def test_doc_symbols():
     test_parse_context()
 
@@ -308,6 +425,8 @@ def test_watcher():
         })
 
     notifications.clear()
+    ctx = srv.ctx[str(Uri.file(build_folder))]
+    version = ctx.version
 
     # Force a reparse:
     request(
@@ -317,11 +436,73 @@ def test_watcher():
                 'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
             },
             'position': Position(0,
-                                 10).__dict__,  # @ CONFIG_TES, should yield CONFIG_TEST_* entries
+                                 10).to_dict(),  # @ CONFIG_TES, should yield CONFIG_TEST_* entries
+        })
+    # The file contents didn't change, so the file tree shouldn't be parsed again:
+    assert ctx.version == version
+    assert not [n for n in notifications if n.method == 'textDocument/publishDiagnostics']
+
+    # Created files may add to the file tree:
+    notify(
+        'workspace/didChangeWatchedFiles', {
+            'changes': [{
+                'uri': str(Uri.file(path.join(zephyr_root, 'Kconfig'))),
+                'type': FileChangeKind.CREATED
+            }]
         })
-    # Should have parsed the file tree again.
-    # Determine this by the diagnostics posting:
-    assert len([n for n in notifications if n.method == 'textDocument/publishDiagnostics']) > 0
+    request('textDocument/completion',
+            {'textDocument': {
+                'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf'))),
+            }})
+
+    # Should have parsed the file tree again:
+    assert ctx.version > version
+
+
+def test_watcher_burst():
+    test_parse_context()
+    ctx = srv.ctx[str(Uri.file(build_folder))]
+    delay = srv.invalidate_delay
+    srv.invalidate_delay = 10
+
+    for kind in [FileChangeKind.CHANGED, FileChangeKind.CREATED, FileChangeKind.CHANGED]:
+        notify(
+            'workspace/didChangeWatchedFiles', {
+                'changes': [{
+                    'uri': str(Uri.file(path.join(zephyr_root, 'Kconfig'))),
+                    'type': kind
+                }]
+            })
+
+    # The invalidations are coalesced until the burst is over:
+    assert ctx.valid
+    assert srv._pending_invalidations == {ctx: False}
+
+    # Requests flush the pending invalidations before using the context:
+    version = ctx.version
+    request('textDocument/completion',
+            {'textDocument': {
+                'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf'))),
+            }})
+    assert not srv._pending_invalidations
+    assert ctx.version > version
+
+    # Devicetree changes only affect the context of their build directory:
+    for folder in [zephyr_root, build_folder]:
+        notify(
+            'workspace/didChangeWatchedFiles', {
+                'changes': [{
+                    'uri': str(Uri.file(path.join(folder, 'zephyr', 'edt.pickle'))),
+                    'type': FileChangeKind.CHANGED
+                }]
+            })
+    assert srv._pending_invalidations == {ctx: True}
+
+    # Don't leave the pending invalidation and its timer behind:
+    srv.flush_invalidations()
+    assert not srv._pending_invalidations
+    assert 'invalidate' not in srv._timers
+    srv.invalidate_delay = delay
 
 
 def test_hover():
@@ -334,7 +515,7 @@ def test_hover():
                 'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
             },
             'position': Position(0,
-                                 10).__dict__,  # @ CONFIG_TES, should yield CONFIG_TEST_* entries
+                                 10).to_dict(),  # @ CONFIG_TES, should yield CONFIG_TEST_* entries
         })
     assert rsp.result['contents']['value']
 
@@ -344,7 +525,7 @@ def test_hover():
             'textDocument': {
                 'uri': str(Uri.file(path.join(zephyr_root, 'Kconfig')))
             },
-            'position': Position(5, 21).__dict__,  # @ TEST_ENTRY2
+            'position': Position(5, 21).to_dict(),  # @ TEST_ENTRY2
         })
     assert rsp.result['contents']['value']
 
@@ -354,7 +535,7 @@ def test_hover():
             'textDocument': {
                 'uri': str(Uri.file(path.join(zephyr_root, 'source.c')))
             },
-            'position': Position(1, 20).__dict__,  # @ CONFIG_TEST_ENTRY1
+            'position': Position(1, 20).to_dict(),  # @ CONFIG_TEST_ENTRY1
         })
     assert rsp.result['contents']['value']
 
@@ -564,7 +745,7 @@ def test_no_contexts():
                     # File exists, but there's no matching context:
                     'uri': str(Uri.file(path.join(zephyr_root, 'Kconfig')))
                 },
-                'position': Position(5, 5).__dict__,
+                'position': Position(5, 5).to_dict(),
             })
         # This should just fail silently.
         # Errors should only be reported for critical failures.
@@ -586,7 +767,7 @@ def test_unknown_docs():
                 'textDocument': {
                     'uri': str(Uri.file(path.join(zephyr_root, 'non_existent_file')))
                 },
-                'position': Position(5, 5).__dict__,
+                'position': Position(5, 5).to_dict(),
             })
         # This should just fail silently.
         # Errors should only be reported for critical failures.
@@ -619,7 +800,9 @@ def test_change_triggering_reparse():
             }]
         })
     diags = [n.params for n in notifications if n.method == 'textDocument/publishDiagnostics']
-    assert len(diags) == 3
+
+    # Only the changed file has new diagnostics:
+    assert [d['uri'] for d in diags] == [str(Uri.file(path.join(zephyr_root, 'prj.conf')))]
 
     # Should remove all errors except the CONFIG_BT_MESH_DEBUG issue
     for d in diags:
@@ -629,6 +812,47 @@ def test_change_triggering_reparse():
         assert len(d['diagnostics']) == 0
 
 
+def test_change_debounce():
+    test_parse_context()
+    srv.diag_delay = 0.05
+
+    def change(version, text):
+        notify(
+            'textDocument/didChange', {
+                'textDocument': {
+                    'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf'))),
+                    'version': version,
+                },
+                'contentChanges': [{
+                    'range': {
+                        'start': {
+                            'line': 0,
+                            'character': 0,
+                        },
+                        'end': {
+                            'line': 0,
+                            'character': 0,
+                        }
+                    },
+                    'text': text
+                }]
+            })
+
+    notifications.clear()
+    change(1, 'CONFIG_UNDEFINED_ENTRY=y\n')
+    change(2, 'CONFIG_UNDEFINED_ENTRY=y\n')
+
+    # Diagnostics aren't refreshed until the changes stop:
+    assert not [n for n in notifications if n.method == 'textDocument/publishDiagnostics']
+
+    time.sleep(0.2)
+    recv()
+
+    # Both changes are covered by a single refresh:
+    diags = [n.params for n in notifications if n.method == 'textDocument/publishDiagnostics']
+    assert [d['uri'] for d in diags] == [str(Uri.file(path.join(zephyr_root, 'prj.conf')))]
+
+
 def test_parser_errors():
     test_parse_context()
 
@@ -656,7 +880,7 @@ def test_parser_errors():
         })
 
     diags = [n.params for n in notifications if n.method == 'textDocument/publishDiagnostics']
-    assert len(diags) == 3
+    assert len(diags) == 1
     conf_diags = next(d for d in diags
                       if d['uri'] == str(Uri.file(path.join(zephyr_root, 'prj.conf'))))
     # Diags from kconfiglib are added at the end:
@@ -716,19 +940,40 @@ def test_set_val():
     rsp = request('kconfig/search', {'query': 'TEST_ENTRY1'})
     assert rsp.result['symbols'][0]['name'] == 'TEST_ENTRY1'
 
+    def menu_names():
+        return [i.get('name') for i in request('kconfig/getMenu', {}).result['items']]
+
+    def completion_labels():
+        return [
+            i['label'] for i in request(
+                'textDocument/completion', {
+                    'textDocument': {
+                        'uri': str(Uri.file(path.join(zephyr_root, 'prj.conf')))
+                    },
+                    'position': Position(3, 0).to_dict(),  # an empty line
+                }).result['items']
+        ]
+
     # invisible because TEST_ENTRY2 (which this depends on) is false
     assert not rsp.result['symbols'][0]['visible']
+    assert 'TEST_ENTRY1' not in menu_names()
+    assert 'CONFIG_TEST_ENTRY1' not in completion_labels()
 
     notify('kconfig/setVal', {'name': 'TEST_ENTRY2', 'val': 'y'})
 
     # No longer invisible, since dependency has been resolved:
     assert request('kconfig/search', {'query': 'TEST_ENTRY1'}).result['symbols'][0]['visible']
+    assert 'TEST_ENTRY1' in menu_names()
+    assert 'CONFIG_TEST_ENTRY1' in completion_labels()
+    assert srv.ctx[str(Uri.file(build_folder))].modified == {'TEST_ENTRY2'}
 
     # Clear value:
     notify('kconfig/setVal', {'name': 'TEST_ENTRY2'})
+    assert not srv.ctx[str(Uri.file(build_folder))].modified
 
     # Invisible again:
     assert not request('kconfig/search', {'query': 'TEST_ENTRY1'}).result['symbols'][0]['visible']
+    assert 'TEST_ENTRY1' not in menu_names()
 
 
 def test_remove_build():
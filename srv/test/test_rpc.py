@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: LicenseRef-Nordic-1-Clause
 
 import json
+import time
 from rpc import RPCError, RPCServer, handler
 from .mock_stream import MockStream, StreamEnd
 
@@ -25,6 +26,19 @@ class Server(RPCServer):
     def handle_error_request(self, params):
         raise RPCError(1234, 'error')
 
+    @handler('burst')
+    def handle_burst(self, params):
+        for i in range(params):
+            self.notify('burstItem', i)
+        return params
+
+    @handler('deferredError')
+    def handle_deferred_error(self, params):
+        def fail():
+            raise Exception('deferred failure')
+
+        self.defer('deferred', 0.01, fail)
+
     @handler('manualResponse')
     def handle_manual_response(self, params):
         self.rsp(params)
@@ -85,6 +99,25 @@ def test_recv():
     assert False
 
 
+def test_recv_split():
+    srv = Server()
+
+    # Deliver the input a few bytes at a time:
+    read1 = srv.io.read1
+    srv.io.read1 = lambda n=-1: read1(7)
+
+    # Messages span several reads, and reads span several messages:
+    push_packet(srv.io, {'jsonrpc': '2.0', 'method': 'test', 'params': 1})
+    push_packet(srv.io, {'jsonrpc': '2.0', 'method': 'test', 'params': 2})
+
+    try:
+        srv.loop()
+    except StreamEnd:
+        assert srv.received == [1, 2]
+        return
+    assert False
+
+
 def test_invalid_len():
     srv = Server()
 
@@ -159,7 +192,7 @@ def test_notify():
     srv = Server()
     srv.notify('someMethod', {'param': [1, 2, 3]})
     notification = pull_packet(srv.io)
-    assert len(notification.headers.keys()) == 2
+    assert len(notification.headers.keys()) == 1
     assert notification.headers['Content-Length']
     assert len(notification.content) == int(notification.headers['Content-Length'])
     assert notification.as_object() == {
@@ -171,6 +204,20 @@ def test_notify():
     }
 
 
+def test_notify_encoded():
+    srv = Server()
+    srv.notify_encoded('someMethod', b'{"param":[1,2,3]}')
+    notification = pull_packet(srv.io)
+    assert len(notification.content) == int(notification.headers['Content-Length'])
+    assert notification.as_object() == {
+        "jsonrpc": "2.0",
+        "method": "someMethod",
+        "params": {
+            "param": [1, 2, 3]
+        }
+    }
+
+
 def test_req():
     srv = Server()
 
@@ -184,7 +231,7 @@ def test_req():
     srv.req('someMethod', {'param': [1, 2, 3]}, handle_rsp)
 
     req = pull_packet(srv.io)
-    assert len(req.headers.keys()) == 2
+    assert len(req.headers.keys()) == 1
     assert req.headers['Content-Length']
     assert len(req.content) == int(req.headers['Content-Length'])
     assert req.as_object() == {
@@ -263,6 +310,27 @@ def test_req_handler():
     assert rsp['result'] == None
 
 
+def test_send_batch():
+    srv = Server()
+    writes = []
+    write = srv.io.write
+    srv.io.write = lambda buf: writes.append(buf) or write(buf)
+
+    push_packet(srv.io, {'jsonrpc': '2.0', 'id': 5, 'method': 'burst', 'params': 3})
+
+    try:
+        srv.loop()
+    except StreamEnd:
+        pass
+
+    # All messages sent while handling the request are written at once, in order:
+    assert len(writes) == 1
+    assert [pull_packet(srv.io).as_object().get('params') for _ in range(3)] == [0, 1, 2]
+    rsp = pull_packet(srv.io).as_object()
+    assert rsp['id'] == 5
+    assert rsp['result'] == 3
+
+
 def test_notification_handler():
     srv = Server()
     req_params = {'test': True}
@@ -281,3 +349,44 @@ def test_notification_handler():
 
     # Expect no response, as we were sending notifications:
     assert srv.io.pull() == ''
+
+
+def test_logging(tmp_path):
+    srv = Server()
+    srv.logging = True
+    srv.log_file = str(tmp_path / 'lsp.log')
+
+    push_packet(srv.io, {'jsonrpc': '2.0', 'id': 5, 'method': 'request', 'params': 'logged'})
+    srv.handle(srv._recv())
+
+    # The log is flushed after each message, without waiting for the loop to end:
+    with open(srv.log_file) as f:
+        log = f.read()
+    assert 'dbg: recv: ' in log
+    assert 'dbg: send: ' in log
+    assert pull_packet(srv.io).as_object()['result'] == 'logged'
+
+
+def test_scheduled_errors(tmp_path):
+    srv = Server()
+    srv.logging = True
+    srv.log_file = str(tmp_path / 'lsp.log')
+
+    def fail():
+        raise Exception('scheduled failure')
+
+    # Exceptions in scheduled callbacks end up in the log, with a traceback:
+    srv.schedule('failing', 0.01, fail)
+    time.sleep(0.1)
+    with open(srv.log_file) as f:
+        log = f.read()
+    assert 'Scheduled callback "failing" failed:' in log
+    assert 'Exception: scheduled failure' in log
+
+    # Deferred requests respond with an error:
+    push_packet(srv.io, {'jsonrpc': '2.0', 'id': 6, 'method': 'deferredError'})
+    srv.handle(srv._recv())
+    time.sleep(0.1)
+    rsp = pull_packet(srv.io).as_object()
+    assert rsp['id'] == 6
+    assert 'deferred failure' in rsp['error']['message']
@@ -91,3 +91,10 @@ def test_file_windows():
 def test_encode_windows_path():
     uri = lsp.Uri.file('c:\\Users\\User\\folder\\filename')
     assert str(uri) == 'file:///c%3A/Users/User/folder/filename'
+
+
+def test_hash():
+    uri = lsp.Uri.file('/path/to/some/file')
+    assert uri == lsp.Uri.parse('file:///path/to/some/file')
+    assert {uri: 1}.get(lsp.Uri.parse('file:///path/to/some/file')) == 1
+    assert lsp.Uri.file('/path/to/other/file') not in {uri: 1}